@@ -0,0 +1,118 @@
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, Optional
+
+from config import get_logger, ADMISSION_QUEUE_TIMEOUT
+
+logger = get_logger(__name__)
+
+
+class QueueFullError(Exception):
+    """Raised when a request is shed because the server is at capacity."""
+
+
+class AdmissionController:
+    """Caps concurrent work and queues a bounded number of waiters in FIFO order."""
+
+    def __init__(
+        self,
+        name: str,
+        max_concurrent: int,
+        max_queue: int,
+        queue_timeout: float = ADMISSION_QUEUE_TIMEOUT,
+        update_interval: float = 1.0,
+    ):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.update_interval = update_interval
+        self.active = 0
+        self.waiters = deque()
+        self.admitted = 0
+        self.rejected = 0
+
+    def position(self, waiter) -> int:
+        return self.waiters.index(waiter) + 1
+
+    async def _wait(
+        self, waiter, on_queued: Optional[Callable[[int], Awaitable[None]]]
+    ):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.queue_timeout
+        last_position = None
+
+        while True:
+            position = self.position(waiter)
+            if on_queued is not None and position != last_position:
+                await on_queued(position)
+                last_position = position
+                if waiter.done():
+                    return
+
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError
+            try:
+                await asyncio.wait_for(
+                    asyncio.shield(waiter), min(remaining, self.update_interval)
+                )
+                return
+            except asyncio.TimeoutError:
+                continue
+
+    @asynccontextmanager
+    async def admit(
+        self, on_queued: Optional[Callable[[int], Awaitable[None]]] = None
+    ):
+        """Hold a slot for the duration of the block.
+
+        `on_queued` is awaited with the 1-based queue position whenever it
+        changes. Raises `QueueFullError` when the request is shed.
+        """
+        if self.active < self.max_concurrent and not self.waiters:
+            self.active += 1
+        else:
+            if len(self.waiters) >= self.max_queue:
+                self.rejected += 1
+                raise QueueFullError(f"{self.name} queue is full")
+
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await self._wait(waiter, on_queued)
+            except BaseException as e:
+                if waiter.done() and not waiter.cancelled():
+                    # The slot was handed over while we gave up, pass it on
+                    self._release()
+                else:
+                    waiter.cancel()
+                    self.waiters.remove(waiter)
+                if isinstance(e, asyncio.TimeoutError):
+                    self.rejected += 1
+                    raise QueueFullError(f"Timed out in the {self.name} queue")
+                raise
+
+        self.admitted += 1
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self):
+        # Hand the slot straight to the next waiter so it can't be overtaken
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(True)
+                return
+        self.active -= 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "active": self.active,
+            "queued": len(self.waiters),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+        }
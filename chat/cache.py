@@ -0,0 +1,132 @@
+import re
+import numpy as np
+from collections import OrderedDict
+from typing import FrozenSet, List, Optional
+
+from config import get_logger, ANSWER_CACHE_SIZE, ANSWER_CACHE_THRESHOLD
+
+logger = get_logger(__name__)
+
+
+def normalize_question(question: str) -> str:
+    """Lowercase, strip punctuation and collapse whitespace."""
+    question = re.sub(r"[^\w\s/]", " ", question.lower())
+    return " ".join(question.split())
+
+
+def question_identifiers(question: str) -> FrozenSet[str]:
+    """Tokens naming something specific: feed pairs, addresses, versions and
+    proper or contract names, i.e. words with a digit or "/" and capitalized
+    words after the first one."""
+    words = re.findall(r"[\w/]+", question)
+    return frozenset(
+        word.lower()
+        for i, word in enumerate(words)
+        if re.search(r"[\d/]", word)
+        or re.search(r"[A-Z]", word[1:])
+        or (i > 0 and len(word) > 1 and word[0].isupper())
+    )
+
+
+def split_for_replay(answer: str) -> List[str]:
+    """Split an answer into token-sized pieces, keeping the whitespace."""
+    return re.findall(r"\S+\s*|\s+", answer)
+
+
+class AnswerCache:
+    """LRU cache of final answers keyed by normalized question and query vector."""
+
+    def __init__(
+        self,
+        max_entries: int = ANSWER_CACHE_SIZE,
+        similarity_threshold: float = ANSWER_CACHE_THRESHOLD,
+    ):
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self.entries = OrderedDict()
+        self._keys = []
+        self._matrix = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _vectors(self):
+        # Rebuilt lazily after the entries change
+        if self._matrix is None and self.entries:
+            self._keys = list(self.entries.keys())
+            self._matrix = np.stack([self.entries[k]["vector"] for k in self._keys])
+        return self._matrix
+
+    @staticmethod
+    def _unit(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(
+        self, question: str, embedding: List[float], corpus_version: str
+    ) -> Optional[str]:
+        """Return a cached answer for the same or a near-duplicate question.
+
+        Near-duplicates must name the same identifiers: questions about
+        different feeds, networks or contracts embed almost identically.
+        """
+        key = normalize_question(question)
+        entry = self.entries.get(key)
+
+        if entry is None and self.entries and embedding is not None:
+            scores = self._vectors() @ self._unit(embedding)
+            identifiers = question_identifiers(question)
+            for best in np.argsort(-scores):
+                if scores[best] < self.similarity_threshold:
+                    break
+                candidate = self.entries[self._keys[best]]
+                if candidate["identifiers"] == identifiers:
+                    key, entry = self._keys[best], candidate
+                    logger.info(f"Semantic cache match ({scores[best]:.3f}): {key}")
+                    break
+
+        if entry is None or entry["corpus_version"] != corpus_version:
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry["answer"]
+
+    def store(
+        self,
+        question: str,
+        embedding: List[float],
+        answer: str,
+        corpus_version: str,
+    ):
+        if not answer or embedding is None:
+            return
+
+        key = normalize_question(question)
+        self.entries[key] = {
+            "answer": answer,
+            "vector": self._unit(embedding),
+            "identifiers": question_identifiers(question),
+            "corpus_version": corpus_version,
+        }
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        self._matrix = None
+
+    def invalidate(self, corpus_version: str) -> int:
+        """Drop every entry built from a different corpus version."""
+        stale = [
+            key
+            for key, entry in self.entries.items()
+            if entry["corpus_version"] != corpus_version
+        ]
+        for key in stale:
+            del self.entries[key]
+        self._matrix = None
+        logger.info(f"Invalidated {len(stale)} cached answers")
+        return len(stale)
@@ -0,0 +1,168 @@
+import asyncio
+from collections import deque
+from typing import Dict, List, Optional
+
+import aiohttp
+import numpy as np
+import openai
+from langchain.chat_models import ChatOpenAI
+from langchain.embeddings import OpenAIEmbeddings
+
+from config import (
+    get_logger,
+    HTTP_POOL_SIZE,
+    HTTP_KEEPALIVE_TIMEOUT,
+    HTTP_SHARED_SESSION,
+)
+
+logger = get_logger(__name__)
+
+
+class ClientRegistry:
+    """Shared OpenAI clients and the keep-alive HTTP session they all use.
+
+    Clients are keyed by model and API key and built once. Callbacks are
+    passed per call, so a client is never bound to a websocket. Without a
+    shared session the openai library opens a new aiohttp session, and so a
+    new TCP and TLS connection, for every async request.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = HTTP_POOL_SIZE,
+        keepalive_timeout: float = HTTP_KEEPALIVE_TIMEOUT,
+    ):
+        self.pool_size = pool_size
+        self.keepalive_timeout = keepalive_timeout
+        self.llms: Dict[tuple, ChatOpenAI] = {}
+        self.embeddings: Dict[str, OpenAIEmbeddings] = {}
+        self.trace_configs: List[aiohttp.TraceConfig] = [self._connection_tracer()]
+        self.session: Optional[aiohttp.ClientSession] = None
+        self._loop = None
+        # Connection reuse and time-to-first-token measurements
+        self.requests = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.ttft = deque(maxlen=1000)
+
+    def get_llm(self, model: str, api_key: str, streaming: bool = False):
+        """Return the shared chat client for a model and API key."""
+        cache_key = (model, api_key, streaming)
+        if cache_key not in self.llms:
+            self.llms[cache_key] = ChatOpenAI(
+                temperature=0.0,
+                model=model,
+                streaming=streaming,
+                openai_api_key=api_key,
+                # Rate limited calls are retried on another key by the key pool
+                max_retries=1,
+            )
+        return self.llms[cache_key]
+
+    def get_embeddings(self, api_key: str):
+        """Return the shared embeddings client for an API key."""
+        if api_key not in self.embeddings:
+            self.embeddings[api_key] = OpenAIEmbeddings(
+                openai_api_key=api_key, max_retries=1
+            )
+        return self.embeddings[api_key]
+
+    def add_trace_config(self, trace_config: aiohttp.TraceConfig):
+        """Register aiohttp hooks. Call before the session is first used."""
+        self.trace_configs.append(trace_config)
+
+    def get_session(self) -> aiohttp.ClientSession:
+        """Return the shared session, creating it on the running event loop."""
+        loop = asyncio.get_running_loop()
+        if self.session is None or self.session.closed or self._loop is not loop:
+            self._close_stale_session()
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=300,
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector, trace_configs=self.trace_configs
+            )
+            self._loop = loop
+        return self.session
+
+    def _close_stale_session(self):
+        """Close the session of another event loop before replacing it."""
+        session, loop = self.session, self._loop
+        self.session = None
+        if session is None or session.closed:
+            return
+
+        if loop is not None and loop.is_running():
+            # The session's connections belong to its loop, close them there
+            asyncio.run_coroutine_threadsafe(session.close(), loop)
+            return
+
+        # Nothing can await the close once its loop has stopped, so drop the
+        # pooled connections directly
+        connector = session.connector
+        session.detach()
+        try:
+            if connector is not None and not connector.closed:
+                connector._close()
+        except RuntimeError as err:
+            logger.warning(f"Could not close the previous HTTP session: {err}")
+
+    def use_session(self):
+        """Make the openai library use the shared session in this context."""
+        if HTTP_SHARED_SESSION:
+            openai.aiosession.set(self.get_session())
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    def _connection_tracer(self) -> aiohttp.TraceConfig:
+        async def on_request_start(session, context, params):
+            self.requests += 1
+
+        async def on_connection_create_end(session, context, params):
+            self.connections_created += 1
+
+        async def on_connection_reuseconn(session, context, params):
+            self.connections_reused += 1
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace_config
+
+    def record_ttft(self, seconds: float):
+        self.ttft.append(seconds)
+
+    def stats(self) -> Dict[str, float]:
+        connections = self.connections_created + self.connections_reused
+        stats = {
+            "requests": self.requests,
+            "connections_created": self.connections_created,
+            "connections_reused": self.connections_reused,
+            "connection_reuse_ratio": round(
+                self.connections_reused / connections, 3
+            )
+            if connections
+            else 0.0,
+        }
+        if self.ttft:
+            p50, p95 = np.percentile(list(self.ttft), [50, 95])
+            stats["ttft_p50_ms"] = round(p50 * 1000)
+            stats["ttft_p95_ms"] = round(p95 * 1000)
+        return stats
+
+
+client_registry = ClientRegistry()
+
+
+def get_llm(model: str, api_key: str, streaming: bool = False):
+    return client_registry.get_llm(model, api_key, streaming=streaming)
+
+
+def get_embeddings(api_key: str):
+    return client_registry.get_embeddings(api_key)
@@ -0,0 +1,157 @@
+import re
+import time
+from statistics import mean
+from typing import Dict, List, Tuple
+
+import numpy as np
+import tiktoken
+from langchain.docstore.document import Document
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from config import (
+    get_logger,
+    COMPRESSION_ENABLED,
+    COMPRESSION_TOKEN_BUDGET,
+    COMPRESSION_WINDOW_TOKENS,
+)
+
+logger = get_logger(__name__)
+
+encoding = tiktoken.get_encoding("cl100k_base")
+
+
+def split_windows(text: str, window_tokens: int = COMPRESSION_WINDOW_TOKENS):
+    """Split text into (window, tokens) pairs of about `window_tokens` tokens.
+
+    Paragraphs are kept together where they fit, so code blocks stay intact;
+    longer paragraphs are split into sentences.
+    """
+    pieces = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        if not paragraph.strip():
+            continue
+        tokens = len(encoding.encode(paragraph))
+        if tokens <= window_tokens:
+            pieces.append((paragraph, tokens))
+        else:
+            for sentence in re.split(r"(?<=[.!?])\s+", paragraph):
+                pieces.append((sentence, len(encoding.encode(sentence))))
+
+    windows = []
+    current, count = [], 0
+    for piece, tokens in pieces:
+        if current and count + tokens > window_tokens:
+            windows.append(("\n\n".join(current), count))
+            current, count = [], 0
+        current.append(piece)
+        count += tokens
+    if current:
+        windows.append(("\n\n".join(current), count))
+    return windows
+
+
+def compress_documents(
+    question: str,
+    documents: List[Document],
+    budget: int = COMPRESSION_TOKEN_BUDGET,
+) -> Tuple[List[Document], int, int]:
+    """Keep the windows most similar to the question, up to `budget` tokens.
+
+    Windows are scored by TF-IDF cosine similarity and kept in their original
+    order within each document. Returns the documents with the token counts
+    before and after.
+    """
+    windows = [
+        (i, text, tokens)
+        for i, doc in enumerate(documents)
+        for text, tokens in split_windows(doc.page_content)
+    ]
+    tokens_in = sum(tokens for _, _, tokens in windows)
+    if tokens_in <= budget:
+        return documents, tokens_in, tokens_in
+
+    vectorizer = TfidfVectorizer(sublinear_tf=True, stop_words="english")
+    try:
+        matrix = vectorizer.fit_transform([text for _, text, _ in windows])
+        scores = (matrix @ vectorizer.transform([question]).T).toarray().ravel()
+    except ValueError:
+        # Nothing but stop words, keep the leading windows
+        scores = np.zeros(len(windows))
+
+    # Best first; ties keep document order
+    keep = set()
+    tokens_out = 0
+    for w in sorted(range(len(windows)), key=lambda w: -scores[w]):
+        if tokens_out + windows[w][2] <= budget:
+            keep.add(w)
+            tokens_out += windows[w][2]
+
+    kept_texts = {}
+    for w, (i, text, _) in enumerate(windows):
+        if w in keep:
+            kept_texts.setdefault(i, []).append(text)
+
+    compressed = [
+        Document(
+            page_content="\n...\n".join(kept_texts[i]),
+            metadata=dict(documents[i].metadata),
+        )
+        for i in sorted(kept_texts)
+    ]
+    return compressed, tokens_in, tokens_out
+
+
+class CompressionStats:
+    """Compression ratios and answer latency with and without compression."""
+
+    def __init__(self):
+        self.requests = 0
+        self.compressed = 0
+        self.tokens_in = 0
+        self.tokens_out = 0
+        self.answer_seconds = {True: [], False: []}
+
+    def record(self, tokens_in: int, tokens_out: int):
+        self.requests += 1
+        self.compressed += tokens_out < tokens_in
+        self.tokens_in += tokens_in
+        self.tokens_out += tokens_out
+
+    def record_answer(self, seconds: float, compressed: bool):
+        latencies = self.answer_seconds[compressed]
+        latencies.append(seconds)
+        del latencies[:-1000]
+
+    def stats(self) -> Dict[str, float]:
+        stats = {
+            "requests": self.requests,
+            "compressed": self.compressed,
+            "ratio": round(self.tokens_out / self.tokens_in, 3) if self.tokens_in else 1.0,
+        }
+        for compressed, name in [(True, "compressed"), (False, "uncompressed")]:
+            if self.answer_seconds[compressed]:
+                stats[f"answer_ms_{name}"] = round(
+                    mean(self.answer_seconds[compressed]) * 1000
+                )
+        return stats
+
+
+compression_stats = CompressionStats()
+
+
+def maybe_compress(
+    question: str, documents: List[Document], budget: int = COMPRESSION_TOKEN_BUDGET
+):
+    """Compress the documents if enabled. Returns (documents, compressed)."""
+    if not COMPRESSION_ENABLED or not documents:
+        return documents, False
+
+    start = time.perf_counter()
+    documents, tokens_in, tokens_out = compress_documents(question, documents, budget)
+    compression_stats.record(tokens_in, tokens_out)
+    if tokens_out < tokens_in:
+        logger.info(
+            f"Compressed context {tokens_in} -> {tokens_out} tokens "
+            f"({tokens_out / tokens_in:.0%}) in {(time.perf_counter() - start) * 1000:.0f} ms"
+        )
+    return documents, tokens_out < tokens_in
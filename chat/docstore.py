@@ -0,0 +1,223 @@
+import os
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Dict, Iterable, Iterator, List, Optional, Union
+
+from langchain.docstore.base import Docstore
+from langchain.docstore.document import Document
+
+from config import get_logger, DOCSTORE_CACHE_SIZE
+
+logger = get_logger(__name__)
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE documents (
+    store TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    id TEXT NOT NULL,
+    source TEXT,
+    page_content TEXT NOT NULL,
+    metadata TEXT NOT NULL,
+    PRIMARY KEY (store, position)
+);
+CREATE INDEX documents_id ON documents (store, id);
+CREATE INDEX documents_source ON documents (store, source);
+"""
+
+INSERT = "INSERT INTO documents VALUES (?, ?, ?, ?, ?, ?)"
+
+
+def _rows(store: str, items):
+    for position, _id, doc in items:
+        yield (
+            store,
+            position,
+            _id,
+            doc.metadata.get("source"),
+            doc.page_content,
+            json.dumps(doc.metadata, default=str),
+        )
+
+
+def build_docstore(
+    path,
+    vectorstores: Dict[str, "FAISS"],
+    full_docs: List[Document],
+    corpus_version: str = "",
+):
+    """Write the FAISS docstores and the full documents to an SQLite file.
+
+    `vectorstores` maps a store name to an in-memory FAISS vectorstore; row
+    positions follow the index ids. Full documents go to the "full" store.
+    The file is replaced atomically so running workers keep their snapshot.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.executescript(SCHEMA)
+        for store, vectorstore in vectorstores.items():
+            items = (
+                (position, _id, vectorstore.docstore.search(_id))
+                for position, _id in vectorstore.index_to_docstore_id.items()
+            )
+            conn.executemany(INSERT, _rows(store, items))
+        items = ((position, str(position), doc) for position, doc in enumerate(full_docs))
+        conn.executemany(INSERT, _rows("full", items))
+        conn.execute("INSERT INTO meta VALUES ('corpus_version', ?)", (corpus_version,))
+        conn.commit()
+    finally:
+        conn.close()
+
+    os.replace(tmp_path, path)
+    logger.info(f"Wrote docstore {path}")
+
+
+class DiskDocstore:
+    """Read-only SQLite document store with a small LRU cache of hot documents.
+
+    Connections are per thread since FAISS searches run in executor threads.
+    Documents are returned as copies, so callers may modify them.
+    """
+
+    def __init__(self, path, cache_size: int = DOCSTORE_CACHE_SIZE):
+        self.path = str(path)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+            self.local.conn = conn
+        return conn
+
+    @property
+    def corpus_version(self) -> str:
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = 'corpus_version'"
+        ).fetchone()
+        return row[0] if row else ""
+
+    def _cached(self, key) -> Optional[Document]:
+        with self.lock:
+            doc = self.cache.get(key)
+            if doc is None:
+                self.misses += 1
+                return None
+            self.cache.move_to_end(key)
+            self.hits += 1
+        return Document(page_content=doc.page_content, metadata=dict(doc.metadata))
+
+    def _remember(self, key, doc: Document):
+        with self.lock:
+            self.cache[key] = doc
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def _row_to_document(self, key, page_content, metadata) -> Document:
+        doc = Document(page_content=page_content, metadata=json.loads(metadata))
+        self._remember(key, doc)
+        return Document(page_content=doc.page_content, metadata=dict(doc.metadata))
+
+    def get(self, store: str, _id: str) -> Optional[Document]:
+        key = (store, _id)
+        doc = self._cached(key)
+        if doc is not None:
+            return doc
+
+        row = self.conn.execute(
+            "SELECT page_content, metadata FROM documents WHERE store = ? AND id = ?",
+            (store, _id),
+        ).fetchone()
+        return self._row_to_document(key, *row) if row else None
+
+    def get_by_sources(self, store: str, sources: Iterable[str]) -> List[Document]:
+        """Documents whose source is in `sources`, in store order."""
+        sources = list(sources)
+        if not sources:
+            return []
+
+        placeholders = ",".join("?" * len(sources))
+        rows = self.conn.execute(
+            f"SELECT position, id FROM documents WHERE store = ? "
+            f"AND source IN ({placeholders}) ORDER BY position",
+            (store, *sources),
+        ).fetchall()
+        return [self.get(store, _id) for _, _id in rows]
+
+    def id_for_position(self, store: str, position: int) -> str:
+        row = self.conn.execute(
+            "SELECT id FROM documents WHERE store = ? AND position = ?",
+            (store, position),
+        ).fetchone()
+        if row is None:
+            raise KeyError(position)
+        return row[0]
+
+    def iter_texts(self, store: str) -> Iterator[str]:
+        """Page contents of a store in position order, without caching them."""
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        try:
+            for (text,) in conn.execute(
+                "SELECT page_content FROM documents WHERE store = ? ORDER BY position",
+                (store,),
+            ):
+                yield text
+        finally:
+            conn.close()
+
+    def count(self, store: str) -> int:
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM documents WHERE store = ?", (store,)
+        ).fetchone()[0]
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        lookups = self.hits + self.misses
+        return {
+            "cached": len(self.cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+class StoreDocstore(Docstore):
+    """One store of a `DiskDocstore`, as the docstore of a FAISS vectorstore."""
+
+    def __init__(self, disk: DiskDocstore, store: str):
+        self.disk = disk
+        self.store = store
+
+    def search(self, search: str) -> Union[str, Document]:
+        doc = self.disk.get(self.store, search)
+        return doc if doc is not None else f"ID {search} not found."
+
+
+class StoreIndexToId(Mapping):
+    """Lazy FAISS position -> docstore id mapping of one store."""
+
+    def __init__(self, disk: DiskDocstore, store: str):
+        self.disk = disk
+        self.store = store
+
+    def __getitem__(self, position) -> str:
+        return self.disk.id_for_position(self.store, int(position))
+
+    def __len__(self) -> int:
+        return self.disk.count(self.store)
+
+    def __iter__(self):
+        return iter(range(len(self)))
@@ -0,0 +1,89 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, List
+
+from config import get_logger, EMBEDDING_BATCH_WAIT_MS, EMBEDDING_BATCH_SIZE
+
+logger = get_logger(__name__)
+
+
+class EmbeddingBatcher:
+    """Collects concurrent query embeddings into batched embedding requests.
+
+    When no batch is in flight a query is sent right away, so a single user
+    sees no added latency. Otherwise queries wait up to `max_wait_ms`, or
+    until `max_batch_size` are pending, and go out as one request whose
+    vectors are handed back to each waiting coroutine.
+    """
+
+    def __init__(
+        self,
+        embed_batch: Callable[[List[str]], Awaitable[List[List[float]]]],
+        max_wait_ms: float = EMBEDDING_BATCH_WAIT_MS,
+        max_batch_size: int = EMBEDDING_BATCH_SIZE,
+    ):
+        self.embed_batch = embed_batch
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.pending = []
+        self.timer = None
+        # The event loop only keeps weak references to tasks
+        self.tasks = set()
+        self.in_flight = 0
+        self.batches = 0
+        self.texts = 0
+
+    async def embed(self, text: str) -> List[float]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((text, future))
+
+        if self.in_flight == 0 or len(self.pending) >= self.max_batch_size:
+            self._flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.max_wait, self._flush)
+
+        return await future
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pending:
+            return
+
+        batch, self.pending = self.pending, []
+        self.in_flight += 1
+        task = asyncio.create_task(self._send(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _send(self, batch):
+        # The same question asked twice in a batch is embedded once
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        try:
+            vectors = await self.embed_batch(texts)
+        except Exception as err:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(err)
+            return
+        finally:
+            self.in_flight -= 1
+            self.batches += 1
+            self.texts += len(batch)
+            # Queries that piled up behind this batch needn't wait any longer
+            if self.pending and self.in_flight == 0:
+                self._flush()
+
+        by_text = dict(zip(texts, vectors))
+        for text, future in batch:
+            if not future.done():
+                future.set_result(by_text[text])
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "batches": self.batches,
+            "texts": self.texts,
+            "mean_batch_size": round(self.texts / self.batches, 2) if self.batches else 0.0,
+            "requests_saved": self.texts - self.batches,
+        }
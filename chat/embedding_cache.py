@@ -0,0 +1,146 @@
+import asyncio
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import numpy as np
+
+from chat.cache import normalize_question
+from config import (
+    get_logger,
+    EMBEDDING_CACHE_SIZE,
+    EMBEDDING_CACHE_DISK,
+    EMBEDDING_CACHE_PATH,
+)
+
+logger = get_logger(__name__)
+
+
+class EmbeddingCache:
+    """LRU cache of query embeddings keyed by model and normalized text.
+
+    With `path` set, misses fall through to an SQLite tier that persists
+    across restarts and is shared between workers.
+    """
+
+    def __init__(self, max_entries: int = EMBEDDING_CACHE_SIZE, path=None):
+        self.max_entries = max_entries
+        self.path = str(path) if path else None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @property
+    def conn(self) -> Optional[sqlite3.Connection]:
+        if self.path is None:
+            return None
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(model TEXT, text TEXT, vector BLOB, PRIMARY KEY (model, text))"
+            )
+            self.local.conn = conn
+        return conn
+
+    def _remember(self, key, vector: np.ndarray):
+        with self.lock:
+            self.entries[key] = vector
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def _get_memory(self, key) -> Optional[List[float]]:
+        with self.lock:
+            vector = self.entries.get(key)
+            if vector is None:
+                return None
+            self.entries.move_to_end(key)
+            self.memory_hits += 1
+            return vector.tolist()
+
+    def _get_disk(self, key) -> Optional[List[float]]:
+        if self.conn is None:
+            return None
+        try:
+            row = self.conn.execute(
+                "SELECT vector FROM embeddings WHERE model = ? AND text = ?", key
+            ).fetchone()
+        except sqlite3.Error as err:
+            logger.warning(f"Embedding cache read failed: {err}")
+            return None
+        if row is None:
+            return None
+        vector = np.frombuffer(row[0], dtype=np.float32)
+        self._remember(key, vector)
+        self.disk_hits += 1
+        return vector.tolist()
+
+    def _put_disk(self, key, vector: np.ndarray):
+        if self.conn is None:
+            return
+        try:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                    (*key, vector.tobytes()),
+                )
+        except sqlite3.Error as err:
+            logger.warning(f"Embedding cache write failed: {err}")
+
+    async def aembed(
+        self, model: str, text: str, embed: Callable[[], Awaitable[List[float]]]
+    ):
+        """Return the cached embedding of `text`, awaiting `embed` on a miss.
+
+        Only the LRU is read on the event loop; the SQLite tier is read in an
+        executor thread and written in the background.
+        """
+        key = (model, normalize_question(text))
+        embedding = self._get_memory(key)
+        if embedding is not None:
+            return embedding
+
+        loop = asyncio.get_running_loop()
+        if self.path is not None:
+            embedding = await loop.run_in_executor(None, self._get_disk, key)
+            if embedding is not None:
+                return embedding
+
+        self.misses += 1
+        embedding = await embed()
+        vector = np.asarray(embedding, dtype=np.float32)
+        self._remember(key, vector)
+        if self.path is not None:
+            # Errors are logged by _put_disk, nothing waits for the write
+            loop.run_in_executor(None, self._put_disk, key, vector)
+        return embedding
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round((lookups - self.misses) / lookups, 3) if lookups else 0.0,
+        }
+
+
+_embedding_cache: Optional[EmbeddingCache] = None
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    """Return the process-wide embedding cache. It outlives corpus refreshes."""
+    global _embedding_cache
+    if _embedding_cache is None:
+        path = EMBEDDING_CACHE_PATH if EMBEDDING_CACHE_DISK else None
+        _embedding_cache = EmbeddingCache(path=path)
+    return _embedding_cache
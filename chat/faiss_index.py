@@ -0,0 +1,167 @@
+import os
+import time
+from typing import Dict
+
+import faiss
+import numpy as np
+
+from config import (
+    get_logger,
+    FAISS_MMAP,
+    FAISS_INDEX_TYPE,
+    FAISS_NLIST,
+    FAISS_PQ_M,
+    FAISS_HNSW_M,
+    FAISS_TRAIN_SAMPLE,
+    FAISS_NPROBE,
+    FAISS_EF_SEARCH,
+)
+
+logger = get_logger(__name__)
+
+# Newer FAISS builds can map flat index codes without copying them to the heap.
+# Older builds only support mmap for inverted lists, so fall back to that.
+MMAP_FLAGS = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+
+
+def get_memory_usage() -> Dict[str, float]:
+    """Resident, shared (file-backed) and private memory of this process in MB.
+
+    Mapped index pages count as shared, so `private_mb` is the per-worker cost.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            _, resident, shared = f.read().split()[:3]
+    except OSError:
+        return {}
+    page_mb = os.sysconf("SC_PAGE_SIZE") / 2**20
+    return {
+        "rss_mb": round(int(resident) * page_mb, 1),
+        "shared_mb": round(int(shared) * page_mb, 1),
+        "private_mb": round((int(resident) - int(shared)) * page_mb, 1),
+    }
+
+
+def read_index(path, mmap: bool = FAISS_MMAP):
+    """Read a FAISS index, memory-mapped and read-only when `mmap` is set.
+
+    A mapped index must not be rewritten in place; write a new file and
+    rename it over the old one instead (see `write_index`).
+    """
+    start = time.perf_counter()
+    before = get_memory_usage()
+
+    index = None
+    if mmap:
+        try:
+            index = faiss.read_index(str(path), MMAP_FLAGS | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError as err:
+            logger.warning(f"Could not mmap {path}, reading it instead: {err}")
+    if index is None:
+        mmap = False
+        index = faiss.read_index(str(path))
+    tune_index(index)
+
+    # IVF indexes need a direct map to reconstruct vectors by id for MMR
+    try:
+        faiss.extract_index_ivf(index).make_direct_map()
+    except RuntimeError:
+        pass
+
+    after = get_memory_usage()
+    logger.info(
+        f"Loaded {path} ({index.ntotal} vectors, mmap={mmap}) in "
+        f"{(time.perf_counter() - start) * 1000:.0f} ms, "
+        f"private memory {before.get('private_mb')} -> {after.get('private_mb')} MB"
+    )
+    return index
+
+
+def write_index(index, path):
+    """Write an index atomically so mapped readers never see a partial file."""
+    tmp_path = f"{path}.tmp"
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, path)
+
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+
+
+def get_vectors(index) -> np.ndarray:
+    """All vectors of an index in id order."""
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def build_index(
+    vectors: np.ndarray,
+    index_type: str = FAISS_INDEX_TYPE,
+    nlist: int = FAISS_NLIST,
+    pq_m: int = FAISS_PQ_M,
+    hnsw_m: int = FAISS_HNSW_M,
+    train_sample: int = FAISS_TRAIN_SAMPLE,
+    seed: int = 42,
+):
+    """Build an L2 index of `index_type` over `vectors`, keeping their order.
+
+    IVF quantizers are trained on a random sample of at most `train_sample`
+    vectors. Corpora too small to train on get a flat index instead.
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type {index_type}, expected one of {INDEX_TYPES}")
+
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    n, d = vectors.shape
+
+    # k-means wants ~39 points per list, PQ wants 256 points per codebook
+    if not nlist:
+        nlist = int(4 * np.sqrt(n))
+    nlist = max(1, min(nlist, n // 39))
+    min_train = 256 if index_type == "ivf_pq" else 39
+    if index_type.startswith("ivf") and n < max(min_train, 39 * nlist):
+        logger.warning(f"Only {n} vectors, too few to train {index_type}. Using flat.")
+        index_type = "flat"
+
+    if index_type == "flat":
+        index = faiss.IndexFlatL2(d)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(d, hnsw_m)
+    else:
+        quantizer = faiss.IndexFlatL2(d)
+        if index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, d, nlist)
+        else:
+            if d % pq_m:
+                raise ValueError(f"FAISS_PQ_M={pq_m} must divide the dimension {d}")
+            index = faiss.IndexIVFPQ(quantizer, d, nlist, pq_m, 8)
+
+        rng = np.random.default_rng(seed)
+        sample = vectors[rng.choice(n, min(n, train_sample), replace=False)]
+        start = time.perf_counter()
+        index.train(sample)
+        logger.info(
+            f"Trained {index_type} (nlist={nlist}) on {len(sample)} vectors "
+            f"in {time.perf_counter() - start:.1f} s"
+        )
+
+    index.add(vectors)
+    tune_index(index)
+    return index
+
+
+def convert_index(index, index_type: str = FAISS_INDEX_TYPE, **kwargs):
+    """Rebuild an index as `index_type`. Vector ids, and so docstore ids, are kept."""
+    if index_type == "flat" and isinstance(index, faiss.IndexFlat):
+        return index
+    return build_index(get_vectors(index), index_type, **kwargs)
+
+
+def tune_index(index, nprobe: int = FAISS_NPROBE, ef_search: int = FAISS_EF_SEARCH):
+    """Set the query-time search breadth of IVF and HNSW indexes."""
+    try:
+        faiss.extract_index_ivf(index).nprobe = nprobe
+    except RuntimeError:
+        pass
+    hnsw = getattr(faiss.downcast_index(index), "hnsw", None)
+    if hnsw is not None:
+        hnsw.efSearch = ef_search
+    return index
@@ -1,160 +1,160 @@
-from langchain.llms import base
-import tiktoken
+import time
+import asyncio
 from chat.prompts_mem import (
     FINAL_ANSWER_PROMPT,
     FINAL_ANSWER_2_PROMPT,
     QUESTION_MODIFIER_PROMPT,
 )
-from chat.prompts_no_mem import (
-    ROUTER_PROMPT,
+from chat.get_chain_no_mem import (
+    call_llm,
+    calculate_tokens,
+    encoding,
+    process_documents,
+    record_generation,
 )
-from chat.utils import get_retriever_chain, get_streaming_chain
-from utils import createLogHandler
+from metrics import STAGE_SECONDS
+from chat.key_pool import get_key_pool
+from chat.compression import compression_stats
+from chat.utils import get_model_chain, get_streaming_chain, bind_chain
+from utils import createLogHandler, StreamingLLMCallbackHandler
 from schemas import ChatResponse, Sender, MessageType
 
 logger = createLogHandler(__name__, "logs.log")
 
-model = "gpt-3.5-turbo"
-try:
-    encoding = tiktoken.encoding_for_model(model)
-except KeyError:
-    logger.error(f"Encoding for model {model} not found. Using default encoding.")
-    encoding = tiktoken.get_encoding("cl100k_base")
 
-
-def calculate_tokens(document, encoding):
-    """Calculate the number of tokens in a list of documents."""
-    return len(encoding.encode(document))
-
-
-def concatenate_documents(documents, max_tokens):
-    """Combine documents up to a certain token limit."""
-    combined_docs = ""
-    token_count = 0
-    used_docs = []
-
-    for doc in documents:
-        doc_tokens = calculate_tokens(doc.page_content, encoding)
-        if (token_count + doc_tokens) <= max_tokens:
-            combined_docs += f"\n\n{doc.page_content}\nSource: {doc.metadata['source']}"
-            token_count += doc_tokens
-            used_docs.append(doc)
-
-    return combined_docs, used_docs
+def call_llm_final_answer(question, document, memory, chain, callbacks=None):
+    """Call LLM with a question, a single document and the chat history."""
+    return call_llm(
+        FINAL_ANSWER_PROMPT, question, document, chain, callbacks, history=memory.buffer
+    )
 
 
-def call_llm_final_answer(question, document, memory, chain, stream=False):
-    """Call LLM with a question and a single document."""
-    if stream:
-        chain.prompt = FINAL_ANSWER_PROMPT
-        return chain.apredict(
-            question=question, document=document, history=memory.buffer
-        )
-    else:
-        chain.prompt = FINAL_ANSWER_PROMPT
-        return chain.predict(
-            question=question, document=document, history=memory.buffer
-        )
+def call_llm_final_2_answer(question, document, memory, chain, callbacks=None):
+    """Call LLM with a question, the combined answers and the chat history."""
+    return call_llm(
+        FINAL_ANSWER_2_PROMPT, question, document, chain, callbacks, history=memory.buffer
+    )
 
 
-def call_llm_final_2_answer(question, document, memory, chain):
-    """Call LLM with a question and a single document."""
-    chain.prompt = FINAL_ANSWER_2_PROMPT
-    return chain.apredict(question=question, document=document, history=memory.buffer)
+async def modify_question(question, memory, chain):
+    """Rewrite a follow-up question so it stands on its own."""
+    if not memory:
+        return question
 
+    async def call(api_key):
+        modifier_chain = bind_chain(chain, prompt=QUESTION_MODIFIER_PROMPT, api_key=api_key)
+        return await modifier_chain.apredict(question=question, history=memory.buffer)
 
-async def process_documents(question, chain, memory, max_tokens=14_000):
-    """Process a list of documents with LLM calls."""
+    tokens = calculate_tokens(memory.buffer, encoding) + 500
+    modified_question = (await get_key_pool().run(call, tokens=tokens)).strip()
+    logger.debug(f"Modified question: {modified_question}")
+    return modified_question or question
 
-    # Modify question if memory is not empty
-    if memory.chat_memory.messages:
-        logger.debug(f"Processing documents for question: {question}")
-        chain.prompt = QUESTION_MODIFIER_PROMPT
-        modified_question = chain.predict(question=question, history=memory.buffer)
-        logger.debug(f"Modified question: {modified_question}")
 
-    else:
-        modified_question = question
-
-    # Use router to get workkflow to use
-    chain.prompt = ROUTER_PROMPT
-    workflow = chain.predict(question=modified_question)
-    logger.debug(f"Using workflow: {workflow}")
-
-    # Get relevant documents
-    documents = retriever.get_relevant_documents(modified_question, workflow=workflow)
-    batches = []
-    num_llm_calls = 0
-    while documents:
-        batch, used_docs = concatenate_documents(documents, max_tokens)
-        batches.append(batch)
-        # logger.info(f"Calling LLM with {batch}")
-        documents = [doc for doc in documents if doc not in used_docs]
-        num_llm_calls += 1
-        logger.info(
-            f"Num LLM call required: {num_llm_calls}. {len(documents)} documents remaining."
-        )
+def remember_turn(memory, question, answer, chain):
+    """Add the turn to memory and summarize older turns in the background."""
+    memory.add_turn(question, answer)
+    memory.summarize_later(chain)
 
-    return batches, num_llm_calls, workflow
 
+async def get_answer_memory(
+    question,
+    memory,
+    manager,
+    retriever,
+    base_chain,
+    max_tokens=14_000,
+    local_router=None,
+    memory_uuid=None,
+):
+    """Get an answer to a question in the context of the session's memory.
 
-async def get_answer_memory(question, memory, max_tokens=14_000, manager=None):
-    """Process documents and call LLM."""
-
-    # Get retriever and chain
-    retriever, base_chain = get_retriever_chain()
+    Uses the process-wide retriever and chain, like `get_answer`. The turn
+    is added to `memory`, a `SessionMemory`, and every frame sent carries
+    its `memory_uuid`.
+    """
 
     resp = ChatResponse(
-        sender=Sender.BOT, message="Retrieving Documents", type=MessageType.STATUS
+        sender=Sender.BOT,
+        message="Retrieving Documents",
+        type=MessageType.STATUS,
+        memory_uuid=memory_uuid,
     )
     await manager.broadcast(resp)
 
-    # Main code that calls process_documents
-    batches, num_llm_calls, workflow = await process_documents(
-        question, chain=base_chain, memory=memory, max_tokens=max_tokens
+    start = time.perf_counter()
+    modified_question = await modify_question(question, memory, base_chain)
+    rewrite_seconds = time.perf_counter() - start
+
+    # The history shares the context window with the documents
+    batches, num_llm_calls, workflow, compressed, model = await process_documents(
+        question=modified_question,
+        max_tokens=max_tokens,
+        chain=base_chain,
+        retriever=retriever,
+        local_router=local_router,
+        prompt=FINAL_ANSWER_PROMPT,
+        history=memory.buffer,
     )
 
-    # Get the stream chain
-    chain_stream = get_streaming_chain(
-        manager=manager, chain=base_chain, workflow=workflow
-    )
+    STAGE_SECONDS.labels("rewrite", workflow).observe(rewrite_seconds)
+
+    # Get the streaming chain and the handler bound to this websocket
+    chain_stream = get_streaming_chain(chain=base_chain, workflow=workflow, model=model)
+    stream_handler = StreamingLLMCallbackHandler(manager, memory_uuid=memory_uuid)
 
     resp = ChatResponse(
-        sender=Sender.BOT, message=f"Generating Answer", type=MessageType.STATUS
+        sender=Sender.BOT,
+        message=f"Generating Answer",
+        type=MessageType.STATUS,
+        memory_uuid=memory_uuid,
     )
     await manager.broadcast(resp)
 
     if num_llm_calls == 1:
+        generation_start = time.perf_counter()
         result = await call_llm_final_answer(
             question=question,
             document=batches[0],
-            chain=chain_stream,
-            stream=True,
             memory=memory,
+            chain=chain_stream,
+            callbacks=[stream_handler],
         )
-        return result, memory
 
     else:
-        # Handle the list of batches
-        results = []
-        for batch in batches:
-            result = call_llm_final_answer(
-                question=question,
-                document=batch,
-                chain=base_chain,
-                stream=False,
-                memory=memory,
-            )
-            results.append(result)
+        # Handle the list of batches concurrently, on the model they were packed for
+        map_chain = get_model_chain(base_chain, model)
+        map_start = time.perf_counter()
+        results = await asyncio.gather(
+            *[
+                call_llm_final_answer(
+                    question=question, document=batch, memory=memory, chain=map_chain
+                )
+                for batch in batches
+            ]
+        )
+
+        STAGE_SECONDS.labels("map", workflow).observe(time.perf_counter() - map_start)
 
         combined_result = " ".join(results)
 
         logger.info(f"Final LLM call with {len(results)} results.")
-        combined_result = await call_llm_final_2_answer(
+        generation_start = time.perf_counter()
+        result = await call_llm_final_2_answer(
             question=question,
             document=combined_result,
-            chain=chain_stream,
             memory=memory,
+            chain=chain_stream,
+            callbacks=[stream_handler],
         )
 
-        return combined_result, memory
+    # Flush anything still buffered before the END frame goes out
+    await stream_handler.flush()
+    record_generation(workflow, chain_stream, stream_handler, generation_start)
+
+    answer_seconds = time.perf_counter() - start
+    compression_stats.record_answer(answer_seconds, compressed)
+    logger.info(f"Answered with memory in {answer_seconds:.2f} s")
+
+    remember_turn(memory, question, result, base_chain)
+    return result
@@ -1,11 +1,29 @@
+import time
+import asyncio
 import logging
 import tiktoken
+from langchain.docstore.document import Document
 from chat.prompts_no_mem import (
     FINAL_ANSWER_PROMPT,
     FINAL_ANSWER_2_PROMPT,
-    ROUTER_PROMPT,
 )
-from chat.utils import get_retriever_chain, get_streaming_chain
+from chat.router import route_question
+from chat.key_pool import get_key_pool
+from chat.clients import client_registry
+from chat.cache import split_for_replay
+from chat.compression import maybe_compress, compression_stats
+from chat.token_budget import plan_model, prompt_tokens, target_budget
+from chat.utils import bind_chain, get_model_chain, get_streaming_chain
+from chat.hedging import get_hedger
+from config import COMPRESSION_TOKEN_BUDGET, HEDGE_ENABLED, SPECULATIVE_RETRIEVAL
+from utils import StreamingLLMCallbackHandler
+from metrics import (
+    STAGE_SECONDS,
+    MAP_CALLS,
+    TTFT_SECONDS,
+    GENERATION_SECONDS,
+    ANSWERS,
+)
 
 from schemas import ChatResponse, Sender, MessageType
 
@@ -36,6 +54,10 @@ def calculate_tokens(document, encoding):
     return len(encoding.encode(document))
 
 
+def format_document(doc):
+    return f"\n\n{doc.page_content}\nSource: {doc.metadata['source']}"
+
+
 def concatenate_documents(documents, max_tokens):
     """Combine documents up to a certain token limit."""
     combined_docs = ""
@@ -43,48 +65,59 @@ def concatenate_documents(documents, max_tokens):
     used_docs = []
 
     for doc in documents:
-        doc_tokens = calculate_tokens(doc.page_content, encoding)
+        formatted = format_document(doc)
+        doc_tokens = calculate_tokens(formatted, encoding)
         if (token_count + doc_tokens) <= max_tokens:
-            combined_docs += f"\n\n{doc.page_content}\nSource: {doc.metadata['source']}"
+            combined_docs += formatted
             token_count += doc_tokens
             used_docs.append(doc)
 
     return combined_docs, used_docs
 
 
-def call_llm_final_answer(question, document, chain, stream=False):
-    """Call LLM with a question and a single document."""
-    chain.prompt = FINAL_ANSWER_PROMPT
-    if stream:
-        return chain.apredict(question=question, document=document)
-    else:
-        return chain.predict(question=question, document=document)
-
-
-def call_llm_final_2_answer(question, document, chain):
-    """Call LLM with a question and a single document."""
-    chain.prompt = FINAL_ANSWER_2_PROMPT
-    return chain.apredict(question=question, document=document)
-
+def split_document(doc, max_tokens):
+    """Split a document whose formatted text exceeds max_tokens into pieces."""
+    formatted_tokens = calculate_tokens(format_document(doc), encoding)
+    if formatted_tokens <= max_tokens:
+        return [doc]
 
-def process_documents(question, chain, retriever, max_tokens=14_000):
-    """Process a list of documents with LLM calls."""
+    tokens = encoding.encode(doc.page_content)
+    # Room for the content next to its source, with a few tokens spare for
+    # merges where the pieces are joined
+    size = max_tokens - (formatted_tokens - len(tokens)) - 8
+    if size <= 0:
+        logger.warning(
+            f"Source of {doc.metadata['source']} alone exceeds {max_tokens} tokens. "
+            "Dropping it."
+        )
+        return []
+    return [
+        Document(
+            page_content=encoding.decode(tokens[start : start + size]),
+            metadata=dict(doc.metadata),
+        )
+        for start in range(0, len(tokens), size)
+    ]
 
-    # Use router to decide which workflow to use
-    chain.prompt = ROUTER_PROMPT
-    try:
-        workflow = int(chain.predict(question=question))
-    except Exception as e:
-        logger.error(f"Error in router: {e}")
-        workflow = 0
 
-    logger.info(f"Using workflow {workflow}")
+def pack_documents(documents, max_tokens):
+    """Split documents into batches that each fit within max_tokens.
 
-    documents = retriever.get_relevant_documents(question, workflow=workflow)
+    Documents longer than max_tokens are split into pieces that fit.
+    """
+    documents = [
+        piece for doc in documents for piece in split_document(doc, max_tokens)
+    ]
     batches = []
     num_llm_calls = 0
     while documents:
         batch, used_docs = concatenate_documents(documents, max_tokens)
+        if not used_docs:
+            # Nothing fits, another pass would never finish
+            logger.warning(
+                f"{len(documents)} documents don't fit in {max_tokens} tokens. Dropping them."
+            )
+            break
         batches.append(batch)
         # logger.info(f"Calling LLM with {batch}")
         documents = [doc for doc in documents if doc not in used_docs]
@@ -93,12 +126,196 @@ def process_documents(question, chain, retriever, max_tokens=14_000):
             f"LLM call {num_llm_calls} complete. {len(documents)} documents remaining."
         )
 
-    return batches, num_llm_calls, workflow
+    return batches, num_llm_calls
+
+
+def log_pruned_tokens(measure_pruning, workflow):
+    """Log the document tokens MMR pruning saved the routed workflow."""
+    try:
+        pruned_tokens = measure_pruning()
+    except Exception as e:
+        logger.error(f"Error measuring MMR pruning: {e}")
+        return
+
+    if pruned_tokens:
+        logger.info(
+            f"MMR pruning saved {pruned_tokens} document tokens for workflow {workflow}"
+        )
+
+
+def call_llm(prompt, question, document, chain, callbacks=None, **inputs):
+    """Call LLM on a key from the pool, retrying on another key if rate limited.
+
+    Streaming calls, those with `callbacks`, are hedged when HEDGE_ENABLED.
+    Extra `inputs` fill the prompt's other variables, such as `history`.
+    """
+
+    async def call(api_key, callbacks=callbacks):
+        bound_chain = bind_chain(chain, prompt=prompt, api_key=api_key)
+        return await bound_chain.apredict(
+            question=question, document=document, callbacks=callbacks, **inputs
+        )
+
+    # Rough budget: prompt, question and document plus the completion
+    tokens = calculate_tokens(document, encoding) + 1_000
+    tokens += sum(calculate_tokens(value, encoding) for value in inputs.values())
+    if callbacks and HEDGE_ENABLED:
+        # Streamed answers race a duplicate call when the first token is late
+        return get_hedger().run(call, callbacks, tokens=tokens)
+    return get_key_pool().run(call, tokens=tokens)
+
+
+def call_llm_final_answer(question, document, chain, callbacks=None):
+    """Call LLM with a question and a single document."""
+    return call_llm(FINAL_ANSWER_PROMPT, question, document, chain, callbacks)
+
+
+def call_llm_final_2_answer(question, document, chain, callbacks=None):
+    """Call LLM with a question and a single document."""
+    return call_llm(FINAL_ANSWER_2_PROMPT, question, document, chain, callbacks)
+
+
+async def process_documents(
+    question,
+    chain,
+    retriever,
+    max_tokens=14_000,
+    local_router=None,
+    embedding=None,
+    prompt=FINAL_ANSWER_PROMPT,
+    **inputs,
+):
+    """Process a list of documents with LLM calls.
+
+    The documents are packed for the cheapest answer model whose context
+    window fits them next to `prompt` and its other `inputs`, such as
+    `history`, and never more than `max_tokens` per call. Returns (batches,
+    num_llm_calls, workflow, compressed, model).
+    """
+
+    # Retrieval is cheap next to the router call, so retrieve for every
+    # workflow while the router decides and keep the matching documents
+    candidates = None
+    if SPECULATIVE_RETRIEVAL:
+        candidates = asyncio.ensure_future(
+            retriever.aget_candidate_documents(question, embedding=embedding)
+        )
+
+    # Use router to decide which workflow to use
+    try:
+        workflow = await route_question(question, chain, local_router=local_router)
+    except BaseException:
+        if candidates is not None:
+            candidates.cancel()
+        raise
+
+    logger.info(f"Using workflow {workflow}")
+
+    # Only the wait after routing is on the critical path
+    start = time.perf_counter()
+    if candidates is not None:
+        candidates = await candidates
+        # Unknown workflows are answered like short-form ones
+        documents, measure_pruning = candidates.get(workflow, candidates[0])
+    else:
+        documents, measure_pruning = await retriever.aget_selected_documents(
+            question, workflow=workflow, embedding=embedding
+        )
+    STAGE_SECONDS.labels("retrieve", workflow).observe(time.perf_counter() - start)
+
+    def compress_and_pack():
+        overhead = prompt_tokens(prompt, question, **inputs)
+        compressed_documents, compressed = maybe_compress(
+            question,
+            documents,
+            budget=min(COMPRESSION_TOKEN_BUDGET, target_budget(workflow, overhead)),
+        )
+        context_tokens = sum(
+            calculate_tokens(format_document(doc), encoding)
+            for doc in compressed_documents
+        )
+        model, budget = plan_model(context_tokens, overhead)
+        logger.info(
+            f"Planned {model} for workflow {workflow}: {context_tokens} context "
+            f"and {overhead} prompt tokens, {budget} tokens per call"
+        )
+        batches, num_llm_calls = pack_documents(
+            compressed_documents, min(budget, max_tokens)
+        )
+        return batches, num_llm_calls, compressed, model
+
+    # Compression and token counting are CPU bound, keep them off the event loop
+    start = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    batches, num_llm_calls, compressed, model = await loop.run_in_executor(
+        None, compress_and_pack
+    )
+    STAGE_SECONDS.labels("pack", workflow).observe(time.perf_counter() - start)
+    if not num_llm_calls:
+        # Answering from an empty document would look like a real answer
+        raise ValueError(
+            f"No context for workflow {workflow} survived compression and packing "
+            f"of {len(documents)} documents"
+        )
+    MAP_CALLS.labels(workflow).observe(num_llm_calls)
+
+    # Measuring the saving reads and tokenizes documents, so it runs in the
+    # background for the routed workflow only
+    loop.run_in_executor(None, log_pruned_tokens, measure_pruning, workflow)
+
+    return batches, num_llm_calls, workflow, compressed, model
+
+
+def record_generation(workflow, chain_stream, stream_handler, generation_start):
+    """Record the streamed generation's duration and time to first token."""
+    model = chain_stream.llm.model_name
+    GENERATION_SECONDS.labels(workflow, model).observe(
+        time.perf_counter() - generation_start
+    )
+    ANSWERS.labels(workflow, "llm").inc()
+
+    if stream_handler.time_to_first_token is not None:
+        client_registry.record_ttft(stream_handler.time_to_first_token)
+        TTFT_SECONDS.labels(workflow, model).observe(stream_handler.time_to_first_token)
+        logger.info(
+            f"Time to first token: {stream_handler.time_to_first_token * 1000:.0f} ms"
+        )
+
 
+async def replay_answer(answer, manager):
+    """Stream a cached answer with the same framing as a live generation."""
+    stream_handler = StreamingLLMCallbackHandler(manager)
+    for token in split_for_replay(answer):
+        await stream_handler.on_llm_new_token(token)
+    await stream_handler.flush()
 
-async def get_answer(question, manager, retriever, base_chain,max_tokens=14_000):
+
+async def get_answer(
+    question,
+    manager,
+    retriever,
+    base_chain,
+    max_tokens=14_000,
+    local_router=None,
+    answer_cache=None,
+):
     """Get an answer to a question."""
 
+    embedding = None
+    if answer_cache is not None:
+        try:
+            embedding = await retriever.aembed_query(question)
+            cached = answer_cache.lookup(question, embedding, retriever.corpus_version)
+        except Exception as e:
+            logger.error(f"Error in answer cache lookup: {e}")
+            cached = None
+
+        if cached is not None:
+            logger.info("Answer cache hit")
+            ANSWERS.labels("none", "cache").inc()
+            await replay_answer(cached, manager)
+            return cached
+
     # Send a status message
     resp = ChatResponse(
         sender=Sender.BOT, message="Retrieving Documents", type=MessageType.STATUS
@@ -106,14 +323,19 @@ async def get_answer(question, manager, retriever, base_chain,max_tokens=14_000)
     await manager.broadcast(resp)
 
     # Main code that calls process_documents
-    batches, num_llm_calls, workflow = process_documents(
-        question=question, max_tokens=max_tokens, chain=base_chain, retriever=retriever
+    start = time.perf_counter()
+    batches, num_llm_calls, workflow, compressed, model = await process_documents(
+        question=question,
+        max_tokens=max_tokens,
+        chain=base_chain,
+        retriever=retriever,
+        local_router=local_router,
+        embedding=embedding,
     )
 
-    # Get the streaming chain
-    chain_stream = get_streaming_chain(
-        manager=manager, chain=base_chain, workflow=workflow
-    )
+    # Get the streaming chain and the handler bound to this websocket
+    chain_stream = get_streaming_chain(chain=base_chain, workflow=workflow, model=model)
+    stream_handler = StreamingLLMCallbackHandler(manager)
 
     # Send a status message
     resp = ChatResponse(
@@ -122,25 +344,48 @@ async def get_answer(question, manager, retriever, base_chain,max_tokens=14_000)
     await manager.broadcast(resp)
 
     if num_llm_calls == 1:
+        generation_start = time.perf_counter()
         result = await call_llm_final_answer(
-            question=question, document=batches[0], chain=chain_stream, stream=True
+            question=question,
+            document=batches[0],
+            chain=chain_stream,
+            callbacks=[stream_handler],
         )
-        return result
 
     else:
-        # Handle the list of batches
-        results = []
-        for batch in batches:
-            result = call_llm_final_answer(
-                question=question, document=batch, chain=base_chain
-            )
-            results.append(result)
+        # Handle the list of batches concurrently, on the model they were packed for
+        map_chain = get_model_chain(base_chain, model)
+        map_start = time.perf_counter()
+        results = await asyncio.gather(
+            *[
+                call_llm_final_answer(
+                    question=question, document=batch, chain=map_chain
+                )
+                for batch in batches
+            ]
+        )
+        STAGE_SECONDS.labels("map", workflow).observe(time.perf_counter() - map_start)
 
         combined_result = " ".join(results)
 
         logger.info(f"Final LLM call with {len(results)} results.")
-        combined_result = await call_llm_final_2_answer(
-            question=question, document=combined_result, chain=chain_stream
+        generation_start = time.perf_counter()
+        result = await call_llm_final_2_answer(
+            question=question,
+            document=combined_result,
+            chain=chain_stream,
+            callbacks=[stream_handler],
         )
 
-        return combined_result
+    # Flush anything still buffered before the END frame goes out
+    await stream_handler.flush()
+    record_generation(workflow, chain_stream, stream_handler, generation_start)
+
+    answer_seconds = time.perf_counter() - start
+    compression_stats.record_answer(answer_seconds, compressed)
+    logger.info(f"Answered in {answer_seconds:.2f} s (compressed context: {compressed})")
+
+    if answer_cache is not None:
+        answer_cache.store(question, embedding, result, retriever.corpus_version)
+
+    return result
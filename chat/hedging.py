@@ -0,0 +1,233 @@
+import time
+import asyncio
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from langchain.callbacks.base import AsyncCallbackHandler
+
+from chat.clients import client_registry
+from chat.key_pool import get_key_pool, is_key_failure
+from metrics import HEDGES
+from config import (
+    get_logger,
+    HEDGE_PERCENTILE,
+    HEDGE_DEFAULT_DELAY,
+    HEDGE_MIN_DELAY,
+    HEDGE_MIN_SAMPLES,
+    HEDGE_MAX_RATE,
+)
+
+logger = get_logger(__name__)
+
+# Hedges that can be saved up while traffic is calm
+MAX_HEDGE_CREDIT = 10.0
+
+
+class Race:
+    """The attempts of one hedged call and the handlers of the winner."""
+
+    def __init__(self, handlers: List[AsyncCallbackHandler]):
+        self.handlers = handlers
+        self.winner: Optional["AttemptHandler"] = None
+        self.decided = asyncio.Event()
+
+    def decide(self, attempt: "AttemptHandler"):
+        if self.winner is None:
+            self.winner = attempt
+            self.decided.set()
+
+
+class AttemptHandler(AsyncCallbackHandler):
+    """Callbacks of one attempt, forwarded only once it has won the race.
+
+    The first attempt to stream a token wins. Start events come from the
+    primary, so the time to first token is the one the user sees.
+    """
+
+    def __init__(self, race: Race, primary: bool):
+        self.race = race
+        self.primary = primary
+        self.key: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None
+
+    async def _forward(self, method: str, *args, **kwargs):
+        for handler in self.race.handlers:
+            await getattr(handler, method)(*args, **kwargs)
+
+    async def on_llm_start(
+        self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any
+    ) -> None:
+        if self.primary:
+            await self._forward("on_llm_start", serialized, prompts, **kwargs)
+
+    async def on_chat_model_start(
+        self, serialized: Dict[str, Any], messages: List[Any], **kwargs: Any
+    ) -> None:
+        if self.primary:
+            await self._forward("on_chat_model_start", serialized, messages, **kwargs)
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.race.decide(self)
+        if self.race.winner is self:
+            await self._forward("on_llm_new_token", token, **kwargs)
+
+    async def on_llm_end(self, response: Any, **kwargs: Any) -> None:
+        if self.race.winner is self:
+            await self._forward("on_llm_end", response, **kwargs)
+
+    async def on_llm_error(self, error: BaseException, **kwargs: Any) -> None:
+        if self.race.winner is self:
+            await self._forward("on_llm_error", error, **kwargs)
+
+
+class Hedger:
+    """Races a late streaming call against a duplicate on another API key.
+
+    The hedge is sent once the call has gone `deadline()` seconds without a
+    token. Each call earns `max_rate` of a hedge, so at most that fraction of
+    calls are hedged over time.
+    """
+
+    def __init__(
+        self,
+        percentile: float = HEDGE_PERCENTILE,
+        default_delay: float = HEDGE_DEFAULT_DELAY,
+        min_delay: float = HEDGE_MIN_DELAY,
+        min_samples: int = HEDGE_MIN_SAMPLES,
+        max_rate: float = HEDGE_MAX_RATE,
+    ):
+        self.percentile = percentile
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.max_rate = max_rate
+        self.credit = 1.0
+        self.calls = 0
+        self.hedged = 0
+        self.won = 0
+        self.skipped = 0
+        self.retried = 0
+
+    def deadline(self) -> float:
+        """Seconds to wait for the first token before hedging."""
+        samples = list(client_registry.ttft)
+        if len(samples) < self.min_samples:
+            return self.default_delay
+        return max(self.min_delay, float(np.percentile(samples, self.percentile)))
+
+    def _take_credit(self) -> bool:
+        if self.credit >= 1:
+            self.credit -= 1
+            return True
+        return False
+
+    async def run(self, call, callbacks: List[AsyncCallbackHandler], tokens: int = 0):
+        """Run `call(key, callbacks=...)` and stream the first attempt to start.
+
+        A primary failing before its first token is retried on another key
+        straight away, outside the hedge budget.
+        """
+        pool = get_key_pool()
+        race = Race(callbacks)
+        self.calls += 1
+        self.credit = min(self.credit + self.max_rate, MAX_HEDGE_CREDIT)
+
+        def start(handler: AttemptHandler, exclude=()):
+            async def attempt():
+                async with pool.lease(tokens=tokens, exclude=exclude) as key:
+                    handler.key = key
+                    return await call(key, callbacks=[handler])
+
+            handler.task = asyncio.create_task(attempt())
+            # Losers are cancelled, don't warn about their unretrieved errors
+            handler.task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            return handler
+
+        primary = start(AttemptHandler(race, primary=True))
+        attempts = [primary]
+        hedge_at = time.monotonic() + self.deadline()
+        errors = []
+
+        try:
+            while race.winner is None:
+                running = [a.task for a in attempts if not a.task.done()]
+                if not running:
+                    raise errors[0]
+
+                timeout = None
+                if hedge_at is not None:
+                    timeout = max(0.0, hedge_at - time.monotonic())
+                decided = asyncio.create_task(race.decided.wait())
+                done, _ = await asyncio.wait(
+                    [decided, *running],
+                    timeout=timeout,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                decided.cancel()
+
+                for a in attempts:
+                    if a.task not in done:
+                        continue
+                    if a.task.exception() is None:
+                        # Finished without streaming a token
+                        race.decide(a)
+                    else:
+                        errors.append(a.task.exception())
+
+                if race.winner is not None or hedge_at is None:
+                    continue
+                if errors:
+                    if not is_key_failure(errors[0]):
+                        raise errors[0]
+                    logger.warning(f"Retrying stream on another API key after: {errors[0]}")
+                    self.retried += 1
+                    HEDGES.labels("retry").inc()
+                elif time.monotonic() < hedge_at:
+                    continue
+                elif self._take_credit():
+                    logger.info("No first token by the deadline, hedging")
+                    self.hedged += 1
+                else:
+                    self.skipped += 1
+                    HEDGES.labels("skipped").inc()
+                    hedge_at = None
+                    continue
+
+                exclude = [primary.key] if primary.key else []
+                attempts.append(start(AttemptHandler(race, primary=False), exclude))
+                hedge_at = None
+        finally:
+            for a in attempts:
+                if a is not race.winner:
+                    a.task.cancel()
+
+        winner = race.winner
+        if len(attempts) > 1 and not errors:
+            if winner is primary:
+                HEDGES.labels("lost").inc()
+            else:
+                self.won += 1
+                HEDGES.labels("won").inc()
+        return await winner.task
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "calls": self.calls,
+            "hedged": self.hedged,
+            "won": self.won,
+            "skipped": self.skipped,
+            "retried": self.retried,
+            "hedge_rate": round(self.hedged / self.calls, 3) if self.calls else 0.0,
+            "deadline_ms": round(self.deadline() * 1000),
+        }
+
+
+_hedger: Optional[Hedger] = None
+
+
+def get_hedger() -> Hedger:
+    """Return the process-wide hedger."""
+    global _hedger
+    if _hedger is None:
+        _hedger = Hedger()
+    return _hedger
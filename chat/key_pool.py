@@ -0,0 +1,242 @@
+import re
+import time
+import random
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+
+import aiohttp
+import openai
+
+from config import (
+    get_logger,
+    OPENAI_API_KEYS,
+    OPENAI_RPM_LIMIT,
+    OPENAI_TPM_LIMIT,
+    KEY_COOLDOWN,
+)
+
+logger = get_logger(__name__)
+
+# Errors that bench a key and are worth retrying on another one
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIError,
+    openai.error.Timeout,
+)
+
+
+def parse_reset(value: str) -> float:
+    """Parse an OpenAI reset duration such as '1m30s', '6.5s' or '20ms'."""
+    seconds = 0.0
+    for amount, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value or ""):
+        seconds += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return seconds
+
+
+def is_key_failure(error: BaseException) -> bool:
+    """True for 429s and server errors, which say nothing about the request."""
+    if isinstance(error, openai.error.APIError):
+        status = getattr(error, "http_status", None)
+        return status is None or status >= 500
+    return isinstance(error, RETRYABLE_ERRORS)
+
+
+class KeyState:
+    """Usage, budget and circuit breaker state of one API key."""
+
+    def __init__(self, key: str, rpm_limit: int, tpm_limit: int):
+        self.key = key
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self.window = deque()  # (timestamp, tokens) of calls in the last minute
+        self.in_flight = 0
+        # Reported by the x-ratelimit-* response headers
+        self.remaining_requests: Optional[int] = None
+        self.remaining_tokens: Optional[int] = None
+        self.requests_reset_at = 0.0
+        self.tokens_reset_at = 0.0
+        # Circuit breaker
+        self.failures = 0
+        self.open_until = 0.0
+
+    def _trim(self, now: float):
+        while self.window and self.window[0][0] <= now - 60:
+            self.window.popleft()
+
+    def load(self, now: float) -> float:
+        """Fraction of the tightest budget already used, 0 = idle, 1 = exhausted."""
+        self._trim(now)
+        requests = len(self.window) + self.in_flight
+        tokens = sum(t for _, t in self.window)
+        load = max(requests / self.rpm_limit, tokens / self.tpm_limit)
+
+        if self.remaining_requests is not None and now < self.requests_reset_at:
+            load = max(load, 1 - self.remaining_requests / self.rpm_limit)
+        if self.remaining_tokens is not None and now < self.tokens_reset_at:
+            load = max(load, 1 - self.remaining_tokens / self.tpm_limit)
+        return load
+
+    def healthy(self, now: float) -> bool:
+        return now >= self.open_until
+
+    def trip(self, now: float, retry_after: float = 0.0):
+        if not self.healthy(now):
+            # Already benched, e.g. by the response hook for the same call
+            return
+        self.failures += 1
+        cooldown = min(KEY_COOLDOWN * 2 ** (self.failures - 1), 60.0)
+        self.open_until = now + max(cooldown, retry_after)
+
+    def update_from_headers(self, headers, now: float):
+        if "x-ratelimit-limit-requests" in headers:
+            self.rpm_limit = int(headers["x-ratelimit-limit-requests"])
+        if "x-ratelimit-limit-tokens" in headers:
+            self.tpm_limit = int(headers["x-ratelimit-limit-tokens"])
+        if "x-ratelimit-remaining-requests" in headers:
+            self.remaining_requests = int(headers["x-ratelimit-remaining-requests"])
+            self.requests_reset_at = now + parse_reset(
+                headers.get("x-ratelimit-reset-requests", "1s")
+            )
+        if "x-ratelimit-remaining-tokens" in headers:
+            self.remaining_tokens = int(headers["x-ratelimit-remaining-tokens"])
+            self.tokens_reset_at = now + parse_reset(
+                headers.get("x-ratelimit-reset-tokens", "1s")
+            )
+
+
+class ApiKeyPool:
+    """Schedules OpenAI calls on the least loaded healthy key.
+
+    Keys are handed out per call and passed explicitly to the client, never
+    through the environment.
+    """
+
+    def __init__(
+        self,
+        keys: List[str],
+        rpm_limit: int = OPENAI_RPM_LIMIT,
+        tpm_limit: int = OPENAI_TPM_LIMIT,
+    ):
+        if not keys:
+            raise ValueError("Not enough API keys. Set OPENAI_API_KEYS")
+        self.states: Dict[str, KeyState] = {
+            key: KeyState(key, rpm_limit, tpm_limit) for key in keys
+        }
+
+    @property
+    def keys(self) -> List[str]:
+        return list(self.states)
+
+    def acquire(self, tokens: int = 0, exclude=()) -> str:
+        """Reserve the least loaded healthy key for a call of about `tokens`."""
+        now = time.monotonic()
+        candidates = [
+            s for s in self.states.values() if s.key not in exclude
+        ] or list(self.states.values())
+
+        healthy = [s for s in candidates if s.healthy(now)]
+        if healthy:
+            # Shuffle so equally loaded keys share the traffic
+            random.shuffle(healthy)
+            state = min(healthy, key=lambda s: s.load(now))
+        else:
+            # Every breaker is open, try the one that closes first
+            state = min(candidates, key=lambda s: s.open_until)
+
+        state.window.append((now, tokens))
+        state.in_flight += 1
+        return state.key
+
+    def release(self, key: str, error: Optional[BaseException] = None):
+        state = self.states[key]
+        state.in_flight = max(state.in_flight - 1, 0)
+        if isinstance(error, Exception) and is_key_failure(error):
+            self.report_failure(key)
+        elif error is None:
+            state.failures = 0
+
+    def report_failure(self, key: str, retry_after: float = 0.0):
+        state = self.states.get(key)
+        if state is None:
+            return
+        state.trip(time.monotonic(), retry_after=retry_after)
+        logger.warning(
+            f"API key ...{key[-4:]} benched for "
+            f"{state.open_until - time.monotonic():.0f}s"
+        )
+
+    @asynccontextmanager
+    async def lease(self, tokens: int = 0, exclude=()):
+        """Hold a key for the duration of one call."""
+        key = self.acquire(tokens=tokens, exclude=exclude)
+        try:
+            yield key
+        except BaseException as e:
+            self.release(key, error=e)
+            raise
+        else:
+            self.release(key)
+
+    async def run(self, call, tokens: int = 0, attempts: int = 2):
+        """Run `call(key)`, retrying on another key after a 429 or 5xx."""
+        tried = []
+        for attempt in range(attempts):
+            key = self.acquire(tokens=tokens, exclude=tried)
+            tried.append(key)
+            try:
+                result = await call(key)
+            except BaseException as e:
+                self.release(key, error=e)
+                if attempt == attempts - 1 or not is_key_failure(e):
+                    raise
+                logger.warning(f"Retrying on another API key after: {e}")
+            else:
+                self.release(key)
+                return result
+
+    def key_for_headers(self, headers) -> Optional[str]:
+        auth = headers.get("Authorization", "")
+        key = auth[len("Bearer ") :] if auth.startswith("Bearer ") else None
+        return key if key in self.states else None
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        """aiohttp hooks that feed response rate limit headers into the pool."""
+
+        async def on_request_end(session, context, params):
+            key = self.key_for_headers(params.headers)
+            if key is None:
+                return
+            response = params.response
+            self.states[key].update_from_headers(response.headers, time.monotonic())
+            if response.status == 429 or response.status >= 500:
+                retry_after = float(response.headers.get("retry-after", 0) or 0)
+                self.report_failure(key, retry_after=retry_after)
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_end.append(on_request_end)
+        return trace_config
+
+    def stats(self) -> Dict[str, Dict]:
+        now = time.monotonic()
+        return {
+            f"...{s.key[-4:]}": {
+                "load": round(s.load(now), 3),
+                "in_flight": s.in_flight,
+                "healthy": s.healthy(now),
+                "failures": s.failures,
+            }
+            for s in self.states.values()
+        }
+
+
+_key_pool: Optional[ApiKeyPool] = None
+
+
+def get_key_pool() -> ApiKeyPool:
+    """Return the process-wide key pool built from OPENAI_API_KEYS."""
+    global _key_pool
+    if _key_pool is None:
+        _key_pool = ApiKeyPool(OPENAI_API_KEYS)
+    return _key_pool
@@ -0,0 +1,83 @@
+import os
+import pickle
+from collections import defaultdict
+from typing import Dict, Hashable, List, Sequence
+
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from chat.docstore import DiskDocstore
+from config import get_logger, RRF_K
+
+logger = get_logger(__name__)
+
+
+class LexicalIndex:
+    """TF-IDF index over the chunks of one docstore store.
+
+    Row i is the chunk at FAISS position i, so lexical and vector hits can be
+    fused by position. Tokens keep identifiers such as `fulfillRandomWords`
+    and contract addresses whole.
+    """
+
+    def __init__(self, vectorizer: TfidfVectorizer, matrix, corpus_version: str = ""):
+        self.vectorizer = vectorizer
+        self.matrix = matrix
+        self.corpus_version = corpus_version
+
+    @classmethod
+    def build(cls, texts, corpus_version: str = ""):
+        vectorizer = TfidfVectorizer(
+            token_pattern=r"(?u)\b\w[\w.]*\w\b",
+            sublinear_tf=True,
+            dtype=np.float32,
+        )
+        matrix = vectorizer.fit_transform(texts).tocsr()
+        return cls(vectorizer, matrix, corpus_version)
+
+    def search(self, query: str, k: int) -> List[int]:
+        """Positions of the `k` best matching chunks, best first."""
+        scores = (self.matrix @ self.vectorizer.transform([query]).T).toarray().ravel()
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k)[:k]]
+        return candidates[np.argsort(-scores[candidates])].tolist()
+
+    def save(self, path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(self, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+
+def get_lexical_index(folder, docstore: DiskDocstore, store: str) -> LexicalIndex:
+    """Load the lexical index of a store, building it from the docstore if stale."""
+    path = f"{folder}/lexical_{store}.pkl"
+    if os.path.exists(path):
+        index = LexicalIndex.load(path)
+        if index.corpus_version == docstore.corpus_version:
+            return index
+
+    logger.info(f"Building lexical index {path}")
+    index = LexicalIndex.build(docstore.iter_texts(store), docstore.corpus_version)
+    index.save(path)
+    return index
+
+
+def rrf_scores(
+    rankings: Sequence[Sequence[Hashable]], weights: Sequence[float], k: int = RRF_K
+) -> Dict[Hashable, float]:
+    """Sum weight / (k + rank) over the rankings for every item."""
+    scores: Dict[Hashable, float] = defaultdict(float)
+    for ranking, weight in zip(rankings, weights):
+        if not weight:
+            continue
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] += weight / (k + rank)
+    return scores
+
@@ -0,0 +1,145 @@
+import time
+import uuid
+import asyncio
+from collections import OrderedDict, deque
+from typing import Dict, Optional, Tuple
+
+import tiktoken
+
+from chat.prompts_mem import SUMMARY_PROMPT
+from chat.key_pool import get_key_pool
+from chat.utils import bind_chain
+from config import (
+    get_logger,
+    MEMORY_TURNS,
+    MEMORY_TOKEN_BUDGET,
+    MEMORY_MAX_SESSIONS,
+    MEMORY_SESSION_TTL,
+)
+
+logger = get_logger(__name__)
+
+encoding = tiktoken.get_encoding("cl100k_base")
+
+
+def format_turns(turns) -> str:
+    return "\n".join(f"Human: {question}\nAI: {answer}" for question, answer, _ in turns)
+
+
+class SessionMemory:
+    """Conversation memory of one session: recent turns plus a rolling summary.
+
+    The last `max_turns` turns are kept verbatim as long as they fit in
+    `token_budget` tokens. Older turns are folded into the summary by an LLM
+    call that runs after the answer has been sent. Until it returns, prompts
+    use the previous summary plus those turns verbatim, so a follow-up never
+    waits on it.
+    """
+
+    def __init__(self, max_turns: int = MEMORY_TURNS, token_budget: int = MEMORY_TOKEN_BUDGET):
+        self.max_turns = max_turns
+        self.token_budget = token_budget
+        self.turns = deque()
+        self.summary = ""
+        self.evicted = []
+        # Evicted turns the running summary call is folding in
+        self.folding = []
+        self.summarizing: Optional[asyncio.Task] = None
+
+    def __bool__(self):
+        return bool(self.turns or self.summary)
+
+    @property
+    def buffer(self) -> str:
+        """History for the prompts: the summary followed by every turn not in it."""
+        history = format_turns([*self.folding, *self.evicted, *self.turns])
+        if self.summary:
+            history = f"Summary of the earlier conversation: {self.summary}\n{history}"
+        return history
+
+    def add_turn(self, question: str, answer: str):
+        tokens = len(encoding.encode(question)) + len(encoding.encode(answer))
+        self.turns.append((question, answer, tokens))
+
+        # Always keep the latest turn, even if it alone is over budget
+        while len(self.turns) > 1 and (
+            len(self.turns) > self.max_turns
+            or sum(t for _, _, t in self.turns) > self.token_budget
+        ):
+            self.evicted.append(self.turns.popleft())
+
+    def summarize_later(self, chain):
+        """Fold evicted turns into the summary in the background."""
+        if self.evicted and self.summarizing is None:
+            self.summarizing = asyncio.create_task(self._summarize(chain))
+
+    async def _summarize(self, chain):
+        try:
+            while self.evicted:
+                evicted, self.evicted = self.evicted, []
+                self.folding = evicted
+
+                async def call(api_key):
+                    bound_chain = bind_chain(chain, prompt=SUMMARY_PROMPT, api_key=api_key)
+                    return await bound_chain.apredict(
+                        summary=self.summary or "None", turns=format_turns(evicted)
+                    )
+
+                tokens = sum(t for _, _, t in evicted) + 1_000
+                self.summary = (await get_key_pool().run(call, tokens=tokens)).strip()
+                self.folding = []
+                logger.info(f"Summarized {len(evicted)} turns")
+        except Exception as err:
+            # Losing old turns beats failing the conversation
+            logger.error(f"Error summarizing conversation: {err}")
+        finally:
+            self.folding = []
+            self.summarizing = None
+
+
+class SessionStore:
+    """Conversation memories keyed by memory_uuid, with LRU and idle-TTL eviction."""
+
+    def __init__(self, max_sessions: int = MEMORY_MAX_SESSIONS, ttl: float = MEMORY_SESSION_TTL):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.sessions = OrderedDict()
+        self.created = 0
+        self.resumed = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def _expire(self, now: float):
+        while self.sessions:
+            memory_uuid, (_, last_used) = next(iter(self.sessions.items()))
+            if now - last_used < self.ttl and len(self.sessions) <= self.max_sessions:
+                break
+            del self.sessions[memory_uuid]
+            self.evicted += 1
+
+    def get(self, memory_uuid: Optional[str] = None) -> Tuple[str, SessionMemory]:
+        """Return the session's memory, starting a new session if it is unknown."""
+        now = time.monotonic()
+        self._expire(now)
+
+        if memory_uuid in self.sessions:
+            memory, _ = self.sessions.pop(memory_uuid)
+            self.resumed += 1
+        else:
+            memory_uuid = str(uuid.uuid4())
+            memory = SessionMemory()
+            self.created += 1
+
+        self.sessions[memory_uuid] = (memory, now)
+        self._expire(now)
+        return memory_uuid, memory
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "sessions": len(self.sessions),
+            "created": self.created,
+            "resumed": self.resumed,
+            "evicted": self.evicted,
+        }
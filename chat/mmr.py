@@ -0,0 +1,41 @@
+from typing import List, Tuple
+
+import numpy as np
+
+from config import MMR_LAMBDA, MMR_DUPLICATE_THRESHOLD
+
+
+def maximal_marginal_relevance(
+    vectors: np.ndarray,
+    relevance: np.ndarray,
+    lambda_mult: float = MMR_LAMBDA,
+    duplicate_threshold: float = MMR_DUPLICATE_THRESHOLD,
+) -> Tuple[List[int], List[int]]:
+    """Order candidates by MMR and split off near-duplicates.
+
+    Each step picks the candidate maximising
+    `lambda_mult * relevance - (1 - lambda_mult) * max similarity to picked`.
+    A pick whose similarity to an earlier one reaches `duplicate_threshold`
+    is redundant instead. Returns (kept, redundant) candidate indexes.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors = vectors / np.where(norms == 0, 1, norms)
+    similarity = vectors @ vectors.T
+
+    # Max similarity of each candidate to the kept ones
+    max_similarity = np.zeros(len(vectors), dtype=np.float32)
+    remaining = np.ones(len(vectors), dtype=bool)
+    kept, redundant = [], []
+
+    while remaining.any():
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_similarity
+        best = int(np.argmax(np.where(remaining, scores, -np.inf)))
+        remaining[best] = False
+        if kept and max_similarity[best] >= duplicate_threshold:
+            redundant.append(best)
+            continue
+        kept.append(best)
+        max_similarity = np.maximum(max_similarity, similarity[best])
+
+    return kept, redundant
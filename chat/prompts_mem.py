@@ -91,3 +91,26 @@ FINAL_ANSWER_2_PROMPT = ChatPromptTemplate.from_messages(
         HumanMessagePromptTemplate.from_template(final_answer_2_human_template),
     ]
 )
+
+summary_system_template = """
+You are an AI assistant helping a user find information about Chainlink.
+Update the summary of the conversation so far with the new exchanges below.
+Keep the user's goals, the questions asked, the facts and references given in the answers, and any open questions.
+Keep it under 200 words.
+"""
+
+summary_human_template = """
+Current summary: {summary}
+
+New exchanges:
+{turns}
+
+Updated summary:
+"""
+
+SUMMARY_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        SystemMessagePromptTemplate.from_template(summary_system_template),
+        HumanMessagePromptTemplate.from_template(summary_human_template),
+    ]
+)
@@ -0,0 +1,143 @@
+import json
+import time
+import asyncio
+import pickle
+from typing import List, Optional, Tuple
+from sklearn.pipeline import make_pipeline
+from sklearn.linear_model import LogisticRegression
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from chat.prompts_no_mem import ROUTER_PROMPT
+from chat.utils import bind_chain
+from chat.key_pool import get_key_pool
+from metrics import ROUTER_SECONDS
+from config import (
+    get_logger,
+    ROUTER_CONFIDENCE,
+    ROUTER_MODEL_PATH,
+    ROUTER_LOG_PATH,
+)
+
+logger = get_logger(__name__)
+
+# Short-form, long-form and data feed workflows
+WORKFLOWS = {0, 1, 2}
+
+
+class LocalRouter:
+    """TF-IDF + logistic regression router trained on logged LLM decisions."""
+
+    def __init__(self, pipeline, threshold: float = ROUTER_CONFIDENCE):
+        self.pipeline = pipeline
+        self.threshold = threshold
+
+    @classmethod
+    def train(
+        cls,
+        questions: List[str],
+        workflows: List[int],
+        threshold: float = ROUTER_CONFIDENCE,
+    ):
+        pipeline = make_pipeline(
+            TfidfVectorizer(ngram_range=(1, 2), sublinear_tf=True, min_df=1),
+            LogisticRegression(max_iter=1000, class_weight="balanced"),
+        )
+        pipeline.fit(questions, workflows)
+        return cls(pipeline, threshold=threshold)
+
+    def predict(self, question: str) -> Tuple[int, float]:
+        """Return the most likely workflow and its probability."""
+        proba = self.pipeline.predict_proba([question])[0]
+        best = proba.argmax()
+        return int(self.pipeline.classes_[best]), float(proba[best])
+
+    def route(self, question: str) -> Optional[int]:
+        """Return a workflow if the classifier is confident, else None."""
+        workflow, confidence = self.predict(question)
+        if confidence >= self.threshold:
+            return workflow
+        return None
+
+    def save(self, path=ROUTER_MODEL_PATH):
+        with open(path, "wb") as f:
+            pickle.dump(self.pipeline, f)
+
+    @classmethod
+    def load(cls, path=ROUTER_MODEL_PATH, threshold: float = ROUTER_CONFIDENCE):
+        with open(path, "rb") as f:
+            pipeline = pickle.load(f)
+        return cls(pipeline, threshold=threshold)
+
+
+def get_local_router():
+    """Load the trained local router, or return None if there isn't one."""
+    if not ROUTER_MODEL_PATH.exists():
+        logger.warning("Local router not trained. Using the LLM router only.")
+        return None
+    return LocalRouter.load()
+
+
+def log_router_decision(question: str, workflow: int, latency_ms: float):
+    """Append an LLM router decision to the training log."""
+    record = {"question": question, "workflow": workflow, "latency_ms": latency_ms}
+    try:
+        with open(ROUTER_LOG_PATH, "a") as f:
+            f.write(json.dumps(record) + "\n")
+    except Exception as e:
+        logger.error(f"Could not log router decision: {e}")
+
+
+def load_router_decisions(path=ROUTER_LOG_PATH) -> List[dict]:
+    """Read logged router decisions, skipping malformed lines."""
+    records = []
+    with open(path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records
+
+
+async def llm_route(question: str, chain) -> int:
+    """Ask the LLM router which workflow to use."""
+
+    async def call(api_key):
+        router_chain = bind_chain(chain, prompt=ROUTER_PROMPT, api_key=api_key)
+        return await router_chain.apredict(question=question)
+
+    start = time.perf_counter()
+    try:
+        workflow = int(await get_key_pool().run(call, tokens=600))
+    except Exception as e:
+        logger.error(f"Error in router: {e}")
+        return 0
+
+    if workflow not in WORKFLOWS:
+        logger.warning(f"Router returned unknown workflow {workflow}. Using 0.")
+        workflow = 0
+
+    latency = time.perf_counter() - start
+    ROUTER_SECONDS.labels("llm").observe(latency)
+    # Appending to the log is blocking file I/O, keep it off the event loop
+    asyncio.get_running_loop().run_in_executor(
+        None, log_router_decision, question, workflow, latency * 1000
+    )
+    return workflow
+
+
+async def route_question(question: str, chain, local_router=None) -> int:
+    """Pick a workflow locally when confident, falling back to the LLM router."""
+    if local_router is not None:
+        try:
+            with ROUTER_SECONDS.labels("local").time():
+                workflow = local_router.route(question)
+        except Exception as e:
+            logger.error(f"Error in local router: {e}")
+            workflow = None
+
+        if workflow is not None:
+            logger.info(f"Local router picked workflow {workflow}")
+            return workflow
+
+    return await llm_route(question, chain)
@@ -0,0 +1,101 @@
+from typing import List, Tuple
+
+import tiktoken
+
+from config import get_logger, ANSWER_MODELS, COMPLETION_TOKENS, MIN_CONTEXT_TOKENS
+
+logger = get_logger(__name__)
+
+encoding = tiktoken.get_encoding("cl100k_base")
+
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 4_096,
+    "gpt-3.5-turbo-16k": 16_384,
+    "gpt-4": 8_192,
+    "gpt-4-32k": 32_768,
+}
+
+# USD per 1k prompt tokens, only used to order the models
+MODEL_PROMPT_COSTS = {
+    "gpt-3.5-turbo": 0.0015,
+    "gpt-3.5-turbo-16k": 0.003,
+    "gpt-4": 0.03,
+    "gpt-4-32k": 0.06,
+}
+
+# Chat formatting adds a few tokens around every message
+TOKENS_PER_MESSAGE = 4
+
+# Workflows answering from full documents rather than a few chunks
+LONG_FORM_WORKFLOWS = {1}
+
+
+def answer_models(models: List[str] = ANSWER_MODELS) -> List[str]:
+    """The configured models with a known context window, cheapest first."""
+    known = []
+    for model in models:
+        if model in MODEL_CONTEXT_WINDOWS:
+            known.append(model)
+        else:
+            logger.warning(f"Unknown context window for {model}. Skipping it.")
+    if not known:
+        raise ValueError(f"No answer model with a known context window in {models}")
+    return sorted(known, key=lambda model: MODEL_PROMPT_COSTS.get(model, 0.0))
+
+
+def prompt_tokens(prompt, question: str, **inputs) -> int:
+    """Tokens of the prompt with its question and inputs but no document."""
+    messages = prompt.format_messages(question=question, document="", **inputs)
+    return sum(
+        len(encoding.encode(message.content)) + TOKENS_PER_MESSAGE
+        for message in messages
+    )
+
+
+def context_budget(model: str, overhead: int) -> int:
+    """Document tokens that fit next to `overhead` prompt tokens and the answer."""
+    return MODEL_CONTEXT_WINDOWS[model] - overhead - COMPLETION_TOKENS
+
+
+def target_budget(workflow: int, overhead: int) -> int:
+    """How much context a workflow should retrieve before packing.
+
+    Short-form answers only need a few chunks, so their context is trimmed to
+    the cheapest model with room for MIN_CONTEXT_TOKENS. Long-form answers may
+    use the largest window.
+    """
+    models = answer_models()
+    if workflow not in LONG_FORM_WORKFLOWS:
+        for model in models:
+            budget = context_budget(model, overhead)
+            if budget >= MIN_CONTEXT_TOKENS:
+                return budget
+
+    budget = max(context_budget(model, overhead) for model in models)
+    if budget <= 0:
+        raise ValueError(
+            f"Prompt of {overhead} tokens leaves no room for documents in {models}"
+        )
+    return budget
+
+
+def plan_model(context_tokens: int, overhead: int) -> Tuple[str, int]:
+    """Pick the cheapest model whose window fits the context.
+
+    Returns (model, budget), where `budget` is the document tokens per call.
+    When nothing fits, the largest window is used and the context is packed
+    into several calls.
+    """
+    models = answer_models()
+    for model in models:
+        budget = context_budget(model, overhead)
+        if context_tokens <= budget:
+            return model, budget
+
+    model = max(models, key=MODEL_CONTEXT_WINDOWS.get)
+    budget = context_budget(model, overhead)
+    if budget <= 0:
+        raise ValueError(
+            f"Prompt of {overhead} tokens leaves no room for documents in {model}"
+        )
+    return model, budget
@@ -1,23 +1,37 @@
 import os
-import faiss
+import time
 import pickle
+import asyncio
 import tiktoken
+import numpy as np
 from pydantic import BaseModel
-from typing import Any, Dict, List
+from functools import partial
+from typing import Any, Callable, Dict, List, Tuple
 from langchain.chains import LLMChain
 from langchain.vectorstores import FAISS
 from langchain.schema import BaseRetriever
-from langchain.chat_models import ChatOpenAI
+from langchain.embeddings import OpenAIEmbeddings
 from langchain.docstore.document import Document
 from langchain.text_splitter import TokenTextSplitter
 
 from chat.prompts_mem import FINAL_ANSWER_PROMPT
-from utils import createLogHandler, StreamingLLMCallbackHandler
+from chat.key_pool import get_key_pool
+from chat.clients import get_llm, get_embeddings
+from chat.faiss_index import read_index, get_memory_usage
+from chat.embedding_cache import get_embedding_cache
+from chat.embedding_batcher import EmbeddingBatcher
+from chat.lexical import get_lexical_index, rrf_scores
+from chat.mmr import maximal_marginal_relevance
+from chat.docstore import build_docstore, DiskDocstore, StoreDocstore, StoreIndexToId
+from utils import createLogHandler
 from search.search import SearchRetriever
-from config import ROOT_DIR
+from metrics import EMBEDDING_SECONDS, SEARCH_SECONDS
+from config import ROOT_DIR, RRF_VECTOR_WEIGHT, RRF_LEXICAL_WEIGHT, MMR_ENABLED
 
 logger = createLogHandler(__name__, "logs.log")
 
+encoding = tiktoken.get_encoding("cl100k_base")
+
 
 class CustomeSplitter:
     def __init__(self, chunk_threshold=6000, chunk_size=6000, chunk_overlap=50):
@@ -61,9 +75,16 @@ class CustomeSplitter:
 
 
 class CustomRetriever(BaseRetriever, BaseModel):
-    full_docs: List[Document]
+    full_docs: DiskDocstore
     base_retriever_all: BaseRetriever = None
     base_retriever_data: BaseRetriever = None
+    lexical_all: Any = None
+    lexical_data: Any = None
+    embeddings: Any = None
+    embedding_cache: Any = None
+    embedding_batcher: Any = None
+    corpus_version: str = ""
+    key_pool: Any = None
     k_initial: int = 10
     k_final: int = 4
 
@@ -77,13 +98,19 @@ class CustomRetriever(BaseRetriever, BaseModel):
     @classmethod
     def from_documents(
         cls,
-        full_docs: List[Document],
+        full_docs: DiskDocstore,
         vectorstore_all: FAISS,
         vectorstore_data: FAISS,
+        lexical_all: Any = None,
+        lexical_data: Any = None,
         search_kwargs: Dict[str, Any] = {},
         k_initial: int = 10,
         k_final: int = 4,
         logger: Any = None,
+        embeddings: Any = None,
+        embedding_cache: Any = None,
+        corpus_version: str = "",
+        key_pool: Any = None,
         **kwargs: Any,
     ):
         # splitter = RecursiveCharacterTextSplitter(chunk_size=1500, chunk_overlap=50)
@@ -98,51 +125,283 @@ class CustomRetriever(BaseRetriever, BaseModel):
             base_retriever_data=vectorstore_data.as_retriever(
                 search_kwargs={"k": k_initial}
             ),
+            lexical_all=lexical_all,
+            lexical_data=lexical_data,
+            embeddings=embeddings or OpenAIEmbeddings(),
+            embedding_cache=embedding_cache,
+            corpus_version=corpus_version,
+            key_pool=key_pool,
             logger=logger,
         )
 
     def get_relevant_documents(self, query: str, workflow: int = 1) -> List[Document]:
-        self.logger.info(f"Worflow: {workflow}")
+        # BaseRetriever requires a sync method, chat retrieval is async only
+        raise NotImplementedError("Use aget_selected_documents")
+
+    async def aembed_query(self, query: str) -> List[float]:
+        if self.embedding_cache is None:
+            return await self._aembed_query(query)
 
+        return await self.embedding_cache.aembed(
+            self.embeddings.model, query, lambda: self._aembed_query(query)
+        )
+
+    async def _aembed_query(self, query: str) -> List[float]:
+        if self.embedding_batcher is not None:
+            return await self.embedding_batcher.embed(query)
+        return (await self.aembed_batch([query]))[0]
+
+    async def aembed_batch(self, texts: List[str]) -> List[List[float]]:
+        with EMBEDDING_SECONDS.labels(self.embeddings.model).time():
+            if self.key_pool is None:
+                return await self.embeddings.aembed_documents(texts)
+
+            return await self.key_pool.run(
+                lambda key: get_embeddings(key).aembed_documents(texts),
+                tokens=sum(len(text) for text in texts) // 4,
+            )
+
+    async def aget_selected_documents(
+        self, query: str, workflow: int = 1, embedding: List[float] = None
+    ) -> Tuple[List[Document], Callable[[], int]]:
+        """Run the lexical and vector searches concurrently and fuse them.
+
+        The lexical search starts before the query is embedded, and both
+        searches run in executor threads. Returns the workflow's documents
+        and a callable that measures the document tokens MMR pruning saved
+        it, left to the caller so it stays off the critical path.
+        """
+        loop = asyncio.get_running_loop()
+        retriever, lexical = self.get_store(workflow)
+        lexical_hits = loop.run_in_executor(None, self.lexical_search, lexical, query)
+
+        if embedding is None:
+            embedding = await self.aembed_query(query)
+        vector_hits = loop.run_in_executor(None, self.vector_search, retriever, embedding)
+
+        vector_hits, lexical_hits = await asyncio.gather(vector_hits, lexical_hits)
+
+        def fuse_and_select():
+            results, unpruned = self.fuse(retriever, vector_hits, lexical_hits)
+            return (
+                self.select_documents(results, workflow),
+                partial(self.pruned_tokens, results, unpruned, workflow),
+            )
+
+        return await loop.run_in_executor(None, fuse_and_select)
+
+    async def aget_candidate_documents(
+        self, query: str, embedding: List[float] = None
+    ) -> Dict[int, Tuple[List[Document], Callable[[], int]]]:
+        """Documents and pruning measures for every workflow, keyed by workflow.
+
+        Lets retrieval run while the router is still deciding. Each store is
+        searched once: workflows 0 and 1 share the fused chunks of "all".
+        """
+        loop = asyncio.get_running_loop()
+        groups = [(0, 1), (2,)]
+        stores = [self.get_store(workflows[0]) for workflows in groups]
+        lexical_hits = [
+            loop.run_in_executor(None, self.lexical_search, lexical, query)
+            for _, lexical in stores
+        ]
+
+        if embedding is None:
+            embedding = await self.aembed_query(query)
+        vector_hits = [
+            loop.run_in_executor(None, self.vector_search, retriever, embedding)
+            for retriever, _ in stores
+        ]
+
+        def fuse_and_select(workflows, retriever, vector_hits, lexical_hits):
+            results, unpruned = self.fuse(retriever, vector_hits, lexical_hits)
+            return {
+                workflow: (
+                    self.select_documents(results, workflow),
+                    partial(self.pruned_tokens, results, unpruned, workflow),
+                )
+                for workflow in workflows
+            }
+
+        async def search(workflows, retriever, vector_hits, lexical_hits):
+            hits = await asyncio.gather(vector_hits, lexical_hits)
+            return await loop.run_in_executor(
+                None, fuse_and_select, workflows, retriever, *hits
+            )
+
+        candidates = {}
+        for selected in await asyncio.gather(
+            *[
+                search(workflows, retriever, vector, lexical)
+                for workflows, (retriever, _), vector, lexical in zip(
+                    groups, stores, vector_hits, lexical_hits
+                )
+            ]
+        ):
+            candidates.update(selected)
+        return candidates
+
+    def get_store(self, workflow: int):
+        """FAISS retriever and lexical index searched by a workflow."""
         if workflow == 2:
-            results = self.base_retriever_data.get_relevant_documents(query=query)
-            self.logger.info(f"Retrieved {len(results)} documents")
-            return results[: self.k_final]
+            return self.base_retriever_data, self.lexical_data
+        return self.base_retriever_all, self.lexical_all
+
+    def store_name(self, retriever: BaseRetriever) -> str:
+        return "data" if retriever is self.base_retriever_data else "all"
+
+    def vector_search(self, retriever: BaseRetriever, embedding: List[float]) -> List[int]:
+        vector = np.array([embedding], dtype=np.float32)
+        with SEARCH_SECONDS.labels(self.store_name(retriever), "vector").time():
+            _, positions = retriever.vectorstore.index.search(vector, self.k_initial)
+        return [int(p) for p in positions[0] if p != -1]
+
+    def lexical_search(self, lexical: Any, query: str) -> List[int]:
+        if lexical is None or not query or not RRF_LEXICAL_WEIGHT:
+            return []
+        store = "data" if lexical is self.lexical_data else "all"
+        with SEARCH_SECONDS.labels(store, "lexical").time():
+            return lexical.search(query, self.k_initial)
+
+    def fuse(
+        self,
+        retriever: BaseRetriever,
+        vector_hits: List[int],
+        lexical_hits: List[int],
+    ) -> Tuple[List[Document], List[Document]]:
+        """Chunks ranked by weighted reciprocal rank fusion of both searches.
+
+        Near-duplicate chunks are then pruned with MMR. Returns the pruned
+        chunks and, to measure the pruning, the chunks before it.
+        """
+        scores = rrf_scores(
+            [vector_hits, lexical_hits], [RRF_VECTOR_WEIGHT, RRF_LEXICAL_WEIGHT]
+        )
+        positions = sorted(scores, key=scores.get, reverse=True)[: self.k_initial]
+        self.logger.info(
+            f"Fused {len(vector_hits)} vector and {len(lexical_hits)} lexical hits, "
+            f"{len(set(vector_hits) & set(lexical_hits))} in both"
+        )
 
+        documents = self.documents_at(retriever, positions)
+        if not MMR_ENABLED or len(positions) < 2:
+            return documents, documents
+
+        by_position = dict(zip(positions, documents))
+        kept = self.prune_redundant(retriever, positions, scores)
+        return [by_position[position] for position in kept], documents
+
+    def prune_redundant(
+        self,
+        retriever: BaseRetriever,
+        positions: List[int],
+        scores: Dict[int, float],
+    ) -> List[int]:
+        """Reorder chunks by MMR on their indexed vectors, dropping near-duplicates."""
+        try:
+            vectors = retriever.vectorstore.index.reconstruct_batch(
+                np.array(positions, dtype="int64")
+            )
+        except RuntimeError as err:
+            self.logger.warning(f"Skipping MMR, vectors not available: {err}")
+            return positions
+
+        relevance = np.array([scores[p] for p in positions], dtype=np.float32)
+        kept, redundant = maximal_marginal_relevance(vectors, relevance / relevance.max())
+
+        if redundant:
+            self.logger.info(f"MMR dropped {len(redundant)} redundant chunks")
+
+        return [positions[i] for i in kept]
+
+    def pruned_tokens(
+        self, results: List[Document], unpruned: List[Document], workflow: int = 1
+    ) -> int:
+        """Document tokens MMR pruning kept out of the workflow's prompt.
+
+        Compares what the workflow selects from the chunks before and after
+        pruning, counting only the documents that differ. Negative when the
+        chunks that replace pruned ones are longer.
+        """
+        if results is unpruned:
+            return 0
+
+        if workflow == 1:
+            before = self.selected_sources(unpruned)
+            after = self.selected_sources(results)
+            removed = self.full_docs.get_by_sources(
+                "full", [source for source in before if source not in after]
+            )
+            added = self.full_docs.get_by_sources(
+                "full", [source for source in after if source not in before]
+            )
         else:
-            results = self.base_retriever_all.get_relevant_documents(query=query)
-            self.logger.info(f"Retrieved {len(results)} documents")
-            if workflow == 1:
-                doc_ids = [doc.metadata["source"] for doc in results]
+            # Workflows 0 and 2 put the top k_final chunks in the prompt as-is
+            before = unpruned[: self.k_final]
+            after = results[: self.k_final]
+            kept = {doc.page_content for doc in after}
+            ranked = {doc.page_content for doc in before}
+            removed = [doc for doc in before if doc.page_content not in kept]
+            added = [doc for doc in after if doc.page_content not in ranked]
+
+        return sum(len(encoding.encode(doc.page_content)) for doc in removed) - sum(
+            len(encoding.encode(doc.page_content)) for doc in added
+        )
+
+    def documents_at(self, retriever: BaseRetriever, positions: List[int]) -> List[Document]:
+        vectorstore = retriever.vectorstore
+        return [
+            vectorstore.docstore.search(vectorstore.index_to_docstore_id[position])
+            for position in positions
+        ]
+
+    def select_documents(self, results: List[Document], workflow: int = 1) -> List[Document]:
+        self.logger.info(f"Worflow: {workflow}")
+        self.logger.info(f"Retrieved {len(results)} documents")
 
-                # make it a set but keep the order
-                doc_ids = list(dict.fromkeys(doc_ids))[: self.k_final]
+        if workflow == 2:
+            return results[: self.k_final]
 
-                # log to the logger
-                self.logger.info(f"Retrieved {len(doc_ids)} unique documents")
+        if workflow == 1:
+            doc_ids = self.selected_sources(results)
 
-                # get upto 4 documents
-                full_retrieved_docs = [
-                    d for d in self.full_docs if d.metadata["source"] in doc_ids
-                ]
+            # log to the logger
+            self.logger.info(f"Retrieved {len(doc_ids)} unique documents")
 
-                return self.prepare_source(full_retrieved_docs)
+            # get upto 4 documents
+            full_retrieved_docs = self.full_docs.get_by_sources("full", doc_ids)
 
-            full_retrieved_docs = results[: self.k_final]
             return self.prepare_source(full_retrieved_docs)
 
-    async def aget_relevant_documents(self, query: str) -> List[Document]:
-        raise NotImplementedError
+        full_retrieved_docs = results[: self.k_final]
+        return self.prepare_source(full_retrieved_docs)
+
+    def selected_sources(self, results: List[Document]) -> List[str]:
+        """Sources of the full documents workflow 1 answers from."""
+        doc_ids = [doc.metadata["source"] for doc in results]
+
+        # make it a set but keep the order
+        return list(dict.fromkeys(doc_ids))[: self.k_final]
 
     def prepare_source(self, documents: List[Document]) -> List[Document]:
+        """Copies of the documents citing their page rather than their chunk.
 
+        The fused chunks are shared by every workflow's selection, so they're
+        never modified.
+        """
+        prepared = []
         for doc in documents:
             source = doc.metadata["source"]
             if "chunk" in source:
                 source = source.split("chunk")[0].strip()
-                doc.metadata["source"] = source
+            prepared.append(
+                Document(
+                    page_content=doc.page_content,
+                    metadata={**doc.metadata, "source": source},
+                )
+            )
 
-        return documents
+        return prepared
 
 
 def prepare_single_document(document):
@@ -166,82 +425,123 @@ def prepare_multiple_documents(all_answers):
     return "\n\n".join(["Content: " + d["answer"] for d in answer_to_use])
 
 
-def get_retriever_chain():
-
-    folder = f"{ROOT_DIR}/data"
-
-    # Open faiss index all
-    index_all = faiss.read_index(f"{folder}/docs_all.index")
-
-    # Open faiss vector store
-    with open(f"{folder}/faiss_store_all.pkl", "rb") as f:
-        vectorstore_all = pickle.load(f)
-
-    # Put back index
-    vectorstore_all.index = index_all
-
-    # Open faiss index data
-    index_data = faiss.read_index(f"{folder}/docs_data.index")
+def get_corpus_version(folder=f"{ROOT_DIR}/data"):
+    """Identify the ingested corpus by the modification times of its files."""
+    files = ["docs_all.index", "docs_data.index", "documents.pkl"]
+    mtimes = [
+        os.path.getmtime(f"{folder}/{name}")
+        for name in files
+        if os.path.exists(f"{folder}/{name}")
+    ]
+    return str(int(max(mtimes))) if mtimes else ""
+
+
+def load_docstore(folder=f"{ROOT_DIR}/data"):
+    """Open the chat docstore, rebuilding it from the pickles if it is stale."""
+    path = f"{folder}/docstore.sqlite"
+    corpus_version = get_corpus_version(folder)
+    if os.path.exists(path):
+        docstore = DiskDocstore(path)
+        if docstore.corpus_version == corpus_version:
+            return docstore
+
+    logger.info(f"Building {path} from pickles")
+    vectorstores = {}
+    for store in ["all", "data"]:
+        with open(f"{folder}/faiss_store_{store}.pkl", "rb") as f:
+            vectorstores[store] = pickle.load(f)
+    with open(f"{folder}/documents.pkl", "rb") as f:
+        documents = pickle.load(f)
 
-    # Open faiss vector store
-    with open(f"{folder}/faiss_store_data.pkl", "rb") as f:
-        vectorstore_data = pickle.load(f)
+    build_docstore(path, vectorstores, CustomeSplitter().split(documents), corpus_version)
+    return DiskDocstore(path)
 
-    # Put back index
-    vectorstore_data.index = index_data
 
-    # Open documents
-    with open(f"{folder}/documents.pkl", "rb") as f:
-        documents = pickle.load(f)
+def get_retriever_chain():
 
-    splitter = CustomeSplitter()
-    chunked_documents = splitter.split(documents)
+    folder = f"{ROOT_DIR}/data"
+    start = time.perf_counter()
+    key_pool = get_key_pool()
+    embeddings = get_embeddings(key_pool.keys[0])
+
+    # Documents stay on disk and are fetched by id when retrieved
+    docstore = load_docstore(folder)
+
+    # Open faiss indexes
+    vectorstore_all = FAISS(
+        embeddings.embed_query,
+        read_index(f"{folder}/docs_all.index"),
+        StoreDocstore(docstore, "all"),
+        StoreIndexToId(docstore, "all"),
+    )
+    vectorstore_data = FAISS(
+        embeddings.embed_query,
+        read_index(f"{folder}/docs_data.index"),
+        StoreDocstore(docstore, "data"),
+        StoreIndexToId(docstore, "data"),
+    )
 
     retriever = CustomRetriever.from_documents(
-        chunked_documents,
+        docstore,
         vectorstore_all=vectorstore_all,
         vectorstore_data=vectorstore_data,
+        lexical_all=get_lexical_index(folder, docstore, "all"),
+        lexical_data=get_lexical_index(folder, docstore, "data"),
         k_initial=10,
         k_final=4,
         logger=logger,
+        corpus_version=docstore.corpus_version,
+        embeddings=embeddings,
+        embedding_cache=get_embedding_cache(),
+        key_pool=key_pool,
     )
+    retriever.embedding_batcher = EmbeddingBatcher(retriever.aembed_batch)
 
-    # Get chain
-    llm = ChatOpenAI(
-        model="gpt-3.5-turbo",
-        temperature=0.0,
-    )
+    # Get chain. Calls rebind it to the key leased from the pool.
+    llm = get_llm("gpt-3.5-turbo", key_pool.keys[0])
     chain = LLMChain(llm=llm, prompt=FINAL_ANSWER_PROMPT)
 
+    logger.info(
+        f"Retriever chain loaded in {time.perf_counter() - start:.2f} s, "
+        f"memory {get_memory_usage()}"
+    )
+
     return retriever, chain
 
 
-def get_streaming_chain(manager, chain, workflow):
-    """Return a new streaming chain."""
-    stream_handler = StreamingLLMCallbackHandler(manager)
-    # stream_manager =  AsyncCallbackManager([stream_handler])
+def bind_chain(chain, prompt=None, llm=None, api_key=None):
+    """Return a per-request copy of a shared chain with its own prompt and model.
+
+    With `api_key` the copy uses the shared client of the same model for that
+    key. The shared chain is never mutated, so concurrent requests can't swap
+    each other's prompt or model.
+    """
+    if llm is None and api_key is not None:
+        llm = get_llm(chain.llm.model_name, api_key, streaming=chain.llm.streaming)
+    return LLMChain(llm=llm or chain.llm, prompt=prompt or chain.prompt)
+
+
+def get_model_chain(chain, model, streaming=False):
+    """Return a copy of the chain on another model."""
+    api_key = chain.llm.openai_api_key
+    return bind_chain(chain, llm=get_llm(model, api_key, streaming=streaming))
 
+
+def get_streaming_chain(chain, workflow, model=None):
+    """Return a streaming copy of the chain for the workflow.
+
+    `model` is the one planned for the packed context. Without it long-form
+    answers use the 16k model. Pass the websocket callbacks to `apredict`
+    to receive the tokens.
+    """
+    if model is None:
+        model = "gpt-3.5-turbo-16k" if workflow == 1 else "gpt-3.5-turbo"
     if workflow == 1:
-        llm_stream = ChatOpenAI(
-            temperature=0.0,
-            model="gpt-3.5-turbo-16k",
-            streaming=True,
-            callbacks=[stream_handler],
-        )
-        logger.info("Using long-form workflow")
-        chain.llm = llm_stream
+        logger.info(f"Using long-form workflow on {model}")
     else:
-        llm_stream = ChatOpenAI(
-            temperature=0.0,
-            model="gpt-3.5-turbo",
-            streaming=True,
-            # max_tokens=256,
-            callbacks=[stream_handler],
-        )
-        chain.llm = llm_stream
-        logger.info("Using short-form workflow")
+        logger.info(f"Using short-form workflow on {model}")
 
-    return chain
+    return get_model_chain(chain, model, streaming=True)
 
 
 def get_search_retriever():
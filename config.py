@@ -35,3 +35,139 @@ if not os.environ.get("MAX_THREADS"):
     MAX_THREADS = 4
 else:
     MAX_THREADS = int(os.environ.get("MAX_THREADS"))
+
+# Minimum classifier probability for the local router to skip the LLM router
+ROUTER_CONFIDENCE = float(os.environ.get("ROUTER_CONFIDENCE", 0.8))
+ROUTER_MODEL_PATH = DATA_DIR / "router.pkl"
+ROUTER_LOG_PATH = DATA_DIR / "router_decisions.jsonl"
+
+# Semantic answer cache. Besides the similarity threshold, a near-duplicate
+# question must name the same identifiers (feed pairs, addresses, networks,
+# contract names) as the cached one, since those barely move the embedding.
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", 1000))
+ANSWER_CACHE_THRESHOLD = float(os.environ.get("ANSWER_CACHE_THRESHOLD", 0.95))
+
+# Websocket token coalescing. A STREAM frame is sent once the buffered tokens
+# are this old or this long. Set STREAM_FLUSH_MS=0 to send every token.
+STREAM_FLUSH_MS = int(os.environ.get("STREAM_FLUSH_MS", 50))
+STREAM_FLUSH_CHARS = int(os.environ.get("STREAM_FLUSH_CHARS", 64))
+
+# Outbound websocket queues. Connections whose queue stays full, or whose
+# socket write blocks, for SEND_STALL_TIMEOUT seconds are dropped.
+SEND_QUEUE_SIZE = int(os.environ.get("SEND_QUEUE_SIZE", 256))
+SEND_STALL_TIMEOUT = float(os.environ.get("SEND_STALL_TIMEOUT", 10))
+
+# OpenAI API keys and the default per-key budgets used until the rate limit
+# headers of a response report the real ones
+OPENAI_API_KEYS = [
+    key.strip()
+    for key in os.environ.get("OPENAI_API_KEYS", "").split(",")
+    if key.strip()
+]
+OPENAI_RPM_LIMIT = int(os.environ.get("OPENAI_RPM_LIMIT", 3500))
+OPENAI_TPM_LIMIT = int(os.environ.get("OPENAI_TPM_LIMIT", 90000))
+# Seconds a key is benched after a 429/5xx, doubled on each consecutive failure
+KEY_COOLDOWN = float(os.environ.get("KEY_COOLDOWN", 5))
+
+# Hedged streaming answers. When no token has arrived by the HEDGE_PERCENTILE
+# time to first token of recent answers (HEDGE_DEFAULT_DELAY seconds until
+# HEDGE_MIN_SAMPLES are recorded), the call is duplicated on another API key
+# and whichever streams first wins. At most HEDGE_MAX_RATE of calls hedge.
+HEDGE_ENABLED = os.environ.get("HEDGE_ENABLED", "0") == "1"
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", 95))
+HEDGE_DEFAULT_DELAY = float(os.environ.get("HEDGE_DEFAULT_DELAY", 2.0))
+HEDGE_MIN_DELAY = float(os.environ.get("HEDGE_MIN_DELAY", 0.5))
+HEDGE_MIN_SAMPLES = int(os.environ.get("HEDGE_MIN_SAMPLES", 20))
+HEDGE_MAX_RATE = float(os.environ.get("HEDGE_MAX_RATE", 0.1))
+
+# Shared keep-alive HTTP connection pool for async OpenAI calls. Set
+# HTTP_SHARED_SESSION=0 to compare against a new connection per request.
+HTTP_SHARED_SESSION = os.environ.get("HTTP_SHARED_SESSION", "1") != "0"
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 100))
+HTTP_KEEPALIVE_TIMEOUT = float(os.environ.get("HTTP_KEEPALIVE_TIMEOUT", 60))
+
+# Admission control. Work beyond the concurrency limit waits in a bounded
+# queue; requests that find the queue full, or wait longer than
+# ADMISSION_QUEUE_TIMEOUT seconds, are rejected.
+CHAT_MAX_CONCURRENT = int(os.environ.get("CHAT_MAX_CONCURRENT", 8))
+CHAT_MAX_QUEUE = int(os.environ.get("CHAT_MAX_QUEUE", 32))
+SEARCH_MAX_CONCURRENT = int(os.environ.get("SEARCH_MAX_CONCURRENT", 4))
+SEARCH_MAX_QUEUE = int(os.environ.get("SEARCH_MAX_QUEUE", 64))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", 30))
+
+# Memory-map the FAISS indexes so workers share the pages through the kernel
+# page cache instead of each reading a private copy.
+FAISS_MMAP = os.environ.get("FAISS_MMAP", "1") != "0"
+
+# FAISS index built by ingest: "flat" (exact), "ivf_flat", "ivf_pq" or "hnsw".
+# FAISS_NLIST=0 picks about 4 * sqrt(n) lists. FAISS_NPROBE and
+# FAISS_EF_SEARCH trade recall for latency at query time.
+FAISS_INDEX_TYPE = os.environ.get("FAISS_INDEX_TYPE", "flat")
+FAISS_NLIST = int(os.environ.get("FAISS_NLIST", 0))
+FAISS_PQ_M = int(os.environ.get("FAISS_PQ_M", 64))
+FAISS_HNSW_M = int(os.environ.get("FAISS_HNSW_M", 32))
+FAISS_TRAIN_SAMPLE = int(os.environ.get("FAISS_TRAIN_SAMPLE", 50000))
+FAISS_NPROBE = int(os.environ.get("FAISS_NPROBE", 16))
+FAISS_EF_SEARCH = int(os.environ.get("FAISS_EF_SEARCH", 64))
+
+# Number of documents kept in memory by the disk-backed chat docstore
+DOCSTORE_CACHE_SIZE = int(os.environ.get("DOCSTORE_CACHE_SIZE", 256))
+
+# Query embedding cache. The disk tier persists embeddings across restarts
+# and is shared by the workers.
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", 10000))
+EMBEDDING_CACHE_DISK = os.environ.get("EMBEDDING_CACHE_DISK", "0") == "1"
+EMBEDDING_CACHE_PATH = DATA_DIR / "embeddings.sqlite"
+
+# Concurrent query embeddings are sent together. A request waits at most
+# EMBEDDING_BATCH_WAIT_MS for others, and only while another batch is in flight.
+EMBEDDING_BATCH_WAIT_MS = float(os.environ.get("EMBEDDING_BATCH_WAIT_MS", 5))
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", 64))
+
+# Hybrid chat retrieval. Vector and TF-IDF rankings are fused with weighted
+# reciprocal rank fusion; a weight of 0 turns that ranking off.
+RRF_VECTOR_WEIGHT = float(os.environ.get("RRF_VECTOR_WEIGHT", 1.0))
+RRF_LEXICAL_WEIGHT = float(os.environ.get("RRF_LEXICAL_WEIGHT", 1.0))
+RRF_K = int(os.environ.get("RRF_K", 60))
+
+# Maximal marginal relevance over the retrieved chunks. Chunks at least
+# MMR_DUPLICATE_THRESHOLD cosine-similar to a kept chunk are dropped.
+MMR_ENABLED = os.environ.get("MMR_ENABLED", "1") != "0"
+MMR_LAMBDA = float(os.environ.get("MMR_LAMBDA", 0.7))
+MMR_DUPLICATE_THRESHOLD = float(os.environ.get("MMR_DUPLICATE_THRESHOLD", 0.95))
+
+# Retrieve for every workflow while the router is deciding, instead of
+# after it. Set SPECULATIVE_RETRIEVAL=0 to retrieve for the routed one only.
+SPECULATIVE_RETRIEVAL = os.environ.get("SPECULATIVE_RETRIEVAL", "1") != "0"
+
+# Extractive compression of the retrieved context. When the documents exceed
+# COMPRESSION_TOKEN_BUDGET tokens, only the windows most similar to the
+# question are kept.
+COMPRESSION_ENABLED = os.environ.get("COMPRESSION_ENABLED", "1") != "0"
+COMPRESSION_TOKEN_BUDGET = int(os.environ.get("COMPRESSION_TOKEN_BUDGET", 6000))
+COMPRESSION_WINDOW_TOKENS = int(os.environ.get("COMPRESSION_WINDOW_TOKENS", 200))
+
+# Answer models. The token budget planner picks the cheapest of ANSWER_MODELS
+# whose context window holds the prompt, history, packed documents and
+# COMPLETION_TOKENS of answer. Short-form workflows compress their context to
+# fit the cheapest model, long-form ones to fit the largest.
+ANSWER_MODELS = [
+    model.strip()
+    for model in os.environ.get(
+        "ANSWER_MODELS", "gpt-3.5-turbo,gpt-3.5-turbo-16k"
+    ).split(",")
+    if model.strip()
+]
+COMPLETION_TOKENS = int(os.environ.get("COMPLETION_TOKENS", 1000))
+# A short-form workflow moves up to the next model rather than squeeze its
+# context below MIN_CONTEXT_TOKENS, e.g. when a long history fills the window.
+MIN_CONTEXT_TOKENS = int(os.environ.get("MIN_CONTEXT_TOKENS", 1000))
+
+# Conversation memory. The last MEMORY_TURNS turns are kept verbatim within
+# MEMORY_TOKEN_BUDGET tokens; older turns are folded into a rolling summary.
+# Sessions are evicted after MEMORY_SESSION_TTL idle seconds or when more
+# than MEMORY_MAX_SESSIONS are open.
+MEMORY_TURNS = int(os.environ.get("MEMORY_TURNS", 4))
+MEMORY_TOKEN_BUDGET = int(os.environ.get("MEMORY_TOKEN_BUDGET", 1500))
+MEMORY_MAX_SESSIONS = int(os.environ.get("MEMORY_MAX_SESSIONS", 10000))
+MEMORY_SESSION_TTL = float(os.environ.get("MEMORY_SESSION_TTL", 3600))
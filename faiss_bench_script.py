@@ -0,0 +1,113 @@
+import time
+import argparse
+
+import faiss
+import numpy as np
+
+from chat.faiss_index import build_index, get_vectors, tune_index, INDEX_TYPES
+from config import get_logger, DATA_DIR
+
+logger = get_logger(__name__)
+
+
+def load_vectors(path=None, size=None, dim=1536, seed=42):
+    """Vectors of an existing index, or clustered synthetic ones of `size`."""
+    if path:
+        return get_vectors(faiss.read_index(str(path)))
+
+    # Embeddings are clustered by topic, uniform noise would understate recall
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(max(1, size // 100), dim))
+    vectors = centers[rng.integers(len(centers), size=size)]
+    vectors += rng.normal(scale=0.5, size=vectors.shape)
+    return vectors.astype("float32")
+
+
+def time_search(index, queries, k):
+    """Mean and p95 single-query latency in ms, plus the results."""
+    latencies = []
+    results = []
+    for query in queries:
+        start = time.perf_counter()
+        _, ids = index.search(query[None, :], k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        results.append(ids[0])
+    return np.mean(latencies), np.percentile(latencies, 95), np.array(results)
+
+
+def recall_at_k(results, truth):
+    return np.mean([len(set(r) & set(t)) / len(t) for r, t in zip(results, truth)])
+
+
+def bench(vectors, index_types, k, nprobes, ef_searches, num_queries, seed=42):
+    rng = np.random.default_rng(seed)
+    # Perturbed corpus vectors stand in for queries near real content
+    queries = vectors[rng.choice(len(vectors), num_queries, replace=False)]
+    queries = queries + rng.normal(scale=0.01, size=queries.shape).astype("float32")
+
+    flat = build_index(vectors, "flat")
+    flat_ms, flat_p95, truth = time_search(flat, queries, k)
+    print(f"\nn={len(vectors)}  dim={vectors.shape[1]}  k={k}")
+    print("index      param          build s  recall@k  mean ms  p95 ms  speedup")
+    print(
+        f"{'flat':10} {'-':14} {0:7.1f}  {1:8.3f}  {flat_ms:7.2f}  {flat_p95:6.2f}  "
+        f"{1:6.1f}x"
+    )
+
+    for index_type in index_types:
+        if index_type == "flat":
+            continue
+        start = time.perf_counter()
+        index = build_index(vectors, index_type)
+        build_s = time.perf_counter() - start
+
+        if index_type == "hnsw":
+            params = [("efSearch", ef, dict(ef_search=ef)) for ef in ef_searches]
+        else:
+            params = [("nprobe", n, dict(nprobe=n)) for n in nprobes]
+
+        for name, value, kwargs in params:
+            tune_index(index, **kwargs)
+            mean_ms, p95_ms, results = time_search(index, queries, k)
+            print(
+                f"{index_type:10} {name + '=' + str(value):14} {build_s:7.1f}  "
+                f"{recall_at_k(results, truth):8.3f}  {mean_ms:7.2f}  {p95_ms:6.2f}  "
+                f"{flat_ms / mean_ms:6.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure recall@k and latency of approximate FAISS indexes against flat"
+    )
+    parser.add_argument(
+        "--index",
+        default=None,
+        help=f"Benchmark the vectors of an index, e.g. {DATA_DIR}/docs_all.index",
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--types", nargs="+", choices=INDEX_TYPES, default=list(INDEX_TYPES))
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[16, 64, 256])
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    if args.index:
+        # Subsample the real corpus to see how each index scales
+        vectors = load_vectors(args.index)
+        sizes = [s for s in args.sizes if s < len(vectors)] + [len(vectors)]
+    else:
+        vectors = load_vectors(size=max(args.sizes), dim=args.dim)
+        sizes = args.sizes
+
+    for size in sizes:
+        bench(
+            vectors[:size],
+            args.types,
+            args.k,
+            args.nprobe,
+            args.ef_search,
+            min(args.queries, size),
+        )
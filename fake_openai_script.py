@@ -0,0 +1,213 @@
+import json
+import time
+import uuid
+import random
+import asyncio
+import hashlib
+import argparse
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from config import get_logger
+
+logger = get_logger(__name__)
+
+app = FastAPI()
+
+# Overridden from the command line
+settings = argparse.Namespace(
+    latency_ms=300.0,
+    jitter_ms=100.0,
+    tokens_per_sec=50.0,
+    answer_tokens=200,
+    error_rate=0.0,
+    server_error_rate=0.0,
+    dim=1536,
+)
+
+WORDS = (
+    "Chainlink nodes fetch data from off-chain sources and deliver it to smart "
+    "contracts through decentralized oracle networks that aggregate responses "
+    "from independent operators to remove single points of failure"
+).split()
+
+RATE_LIMIT_HEADERS = {
+    "x-ratelimit-limit-requests": "3500",
+    "x-ratelimit-limit-tokens": "90000",
+    "x-ratelimit-remaining-requests": "3499",
+    "x-ratelimit-remaining-tokens": "89000",
+    "x-ratelimit-reset-requests": "17ms",
+    "x-ratelimit-reset-tokens": "666ms",
+}
+
+
+def injected_error():
+    """A 429 or 500 response at the configured rates, otherwise None."""
+    roll = random.random()
+    if roll < settings.error_rate:
+        return JSONResponse(
+            {"error": {"message": "Rate limit reached", "type": "requests", "code": None}},
+            status_code=429,
+            headers={**RATE_LIMIT_HEADERS, "x-ratelimit-remaining-requests": "0"},
+        )
+    if roll < settings.error_rate + settings.server_error_rate:
+        return JSONResponse(
+            {"error": {"message": "The server had an error", "type": "server_error"}},
+            status_code=500,
+        )
+    return None
+
+
+async def first_token_delay():
+    delay = settings.latency_ms + random.uniform(-1, 1) * settings.jitter_ms
+    await asyncio.sleep(max(0.0, delay) / 1000)
+
+
+def answer_for(messages):
+    """Router prompts get a workflow number, everything else filler text."""
+    system = " ".join(m.get("content", "") for m in messages if m.get("role") == "system")
+    if "route the question" in system:
+        return [str(random.randint(0, 2))]
+    return [random.choice(WORDS) + " " for _ in range(settings.answer_tokens)]
+
+
+def usage(messages, completion_tokens):
+    prompt_tokens = sum(len(m.get("content", "")) for m in messages) // 4
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+def chunk(completion_id, model, delta, finish_reason=None):
+    payload = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+async def stream_tokens(completion_id, model, tokens):
+    await first_token_delay()
+    yield chunk(completion_id, model, {"role": "assistant"})
+    interval = 1 / settings.tokens_per_sec if settings.tokens_per_sec > 0 else 0
+    for token in tokens:
+        yield chunk(completion_id, model, {"content": token})
+        await asyncio.sleep(interval)
+    yield chunk(completion_id, model, {}, finish_reason="stop")
+    yield "data: [DONE]\n\n"
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    error = injected_error()
+    if error is not None:
+        return error
+
+    body = await request.json()
+    messages = body.get("messages", [])
+    model = body.get("model", "gpt-3.5-turbo")
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    tokens = answer_for(messages)
+
+    if body.get("stream"):
+        return StreamingResponse(
+            stream_tokens(completion_id, model, tokens),
+            media_type="text/event-stream",
+            headers=RATE_LIMIT_HEADERS,
+        )
+
+    # Non-streaming calls still pay for generating the whole answer
+    await first_token_delay()
+    if settings.tokens_per_sec > 0:
+        await asyncio.sleep(len(tokens) / settings.tokens_per_sec)
+    return JSONResponse(
+        {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(tokens)},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": usage(messages, len(tokens)),
+        },
+        headers=RATE_LIMIT_HEADERS,
+    )
+
+
+def fake_embedding(text):
+    """Deterministic unit vector, so repeated inputs embed identically."""
+    seed = int.from_bytes(hashlib.sha1(text.encode()).digest()[:8], "little")
+    vector = np.random.default_rng(seed).normal(size=settings.dim)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    error = injected_error()
+    if error is not None:
+        return error
+
+    body = await request.json()
+    inputs = body.get("input", [])
+    if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+        inputs = [inputs]
+
+    await first_token_delay()
+    # langchain sends token ids rather than strings
+    texts = [item if isinstance(item, str) else json.dumps(item) for item in inputs]
+    tokens = sum(len(item) if isinstance(item, list) else len(item) // 4 for item in inputs)
+    return JSONResponse(
+        {
+            "object": "list",
+            "data": [
+                {"object": "embedding", "index": i, "embedding": fake_embedding(text)}
+                for i, text in enumerate(texts)
+            ],
+            "model": body.get("model", "text-embedding-ada-002"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        },
+        headers=RATE_LIMIT_HEADERS,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve fake OpenAI chat and embedding endpoints for load testing"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument(
+        "--latency-ms", type=float, default=settings.latency_ms, help="Time to first token"
+    )
+    parser.add_argument("--jitter-ms", type=float, default=settings.jitter_ms)
+    parser.add_argument("--tokens-per-sec", type=float, default=settings.tokens_per_sec)
+    parser.add_argument("--answer-tokens", type=int, default=settings.answer_tokens)
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="Fraction of requests rejected with 429"
+    )
+    parser.add_argument(
+        "--server-error-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of requests failed with 500",
+    )
+    parser.add_argument("--dim", type=int, default=settings.dim)
+    args = parser.parse_args()
+
+    for name in vars(settings):
+        setattr(settings, name, getattr(args, name))
+    logger.info(f"Point the app at http://{args.host}:{args.port}/v1 via OPENAI_API_BASE")
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
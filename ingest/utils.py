@@ -1,5 +1,6 @@
 import re
 import os
+from functools import lru_cache
 from selenium import webdriver
 from selenium.webdriver.chrome.service import Service
 from webdriver_manager.chrome import ChromeDriverManager
@@ -14,7 +15,10 @@ from langchain.prompts import (
 )
 
 
+@lru_cache(maxsize=None)
 def get_description_chain():
+    """Return the shared description chain, built once per ingest process."""
+
     system_template = """
     Please summarize the context below in one sentence (no more than 15 words). This will be used as the description of the article in the search results.
 
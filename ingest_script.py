@@ -1,5 +1,4 @@
 import os
-import faiss
 import pickle
 import requests
 import argparse
@@ -14,8 +13,11 @@ from ingest.education import scrap_education_docs
 from ingest.stackoverflow import scrap_stackoverflow
 from ingest.data import scrap_data
 from ingest.chain_link import scrap_chain_link
-from config import get_logger, DATA_DIR
-from chat.utils import CustomeSplitter
+from config import get_logger, DATA_DIR, FAISS_INDEX_TYPE
+from chat.utils import CustomeSplitter, get_corpus_version
+from chat.docstore import build_docstore, DiskDocstore
+from chat.lexical import get_lexical_index
+from chat.faiss_index import write_index, convert_index, INDEX_TYPES
 from fastapi import HTTPException
 
 logger = get_logger(__name__)
@@ -87,7 +89,7 @@ def get_access_token():
     )
 
 
-def ingest_task():
+def ingest_task(index_type=FAISS_INDEX_TYPE):
     # Get access token
     access_token = get_access_token()
 
@@ -159,20 +161,44 @@ def ingest_task():
         split_docs_data, embedding=OpenAIEmbeddings()
     )
 
-    # Save vectorstores to disk
-    faiss.write_index(vectorstore_all.index, f"{DATA_DIR}/docs_all.index")
+    # Rebuild as an approximate index if configured. Vector ids don't change,
+    # so the docstore mapping stays valid.
+    logger.info(f"Building {index_type} indexes")
+    vectorstore_all.index = convert_index(vectorstore_all.index, index_type)
+    vectorstore_data.index = convert_index(vectorstore_data.index, index_type)
+
+    # Save vectorstores to disk. Running workers map the index files, so
+    # replace them instead of rewriting them in place.
+    write_index(vectorstore_all.index, f"{DATA_DIR}/docs_all.index")
     vectorstore_all.index = None
     with open(f"{DATA_DIR}/faiss_store_all.pkl", "wb") as f:
         pickle.dump(vectorstore_all, f)
 
     # Save vectorstore_data
-    faiss.write_index(vectorstore_data.index, f"{DATA_DIR}/docs_data.index")
+    write_index(vectorstore_data.index, f"{DATA_DIR}/docs_data.index")
     vectorstore_data.index = None
     with open(f"{DATA_DIR}/faiss_store_data.pkl", "wb") as f:
         pickle.dump(vectorstore_data, f)
 
+    # Chat retrieval reads documents from here instead of the pickles
+    build_docstore(
+        f"{DATA_DIR}/docstore.sqlite",
+        {"all": vectorstore_all, "data": vectorstore_data},
+        chunked_full_documents,
+        get_corpus_version(DATA_DIR),
+    )
+
+    # TF-IDF over the same chunks for hybrid chat retrieval
+    docstore = DiskDocstore(f"{DATA_DIR}/docstore.sqlite")
+    for store in ["all", "data"]:
+        get_lexical_index(DATA_DIR, docstore, store)
+
     logger.info("Done")
 
 
 if __name__ == "__main__":
-    ingest_task()
+    parser = argparse.ArgumentParser(description="Scrape sources and build the indexes")
+    parser.add_argument("--index-type", choices=INDEX_TYPES, default=FAISS_INDEX_TYPE)
+    args = parser.parse_args()
+
+    ingest_task(index_type=args.index_type)
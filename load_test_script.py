@@ -0,0 +1,128 @@
+import json
+import time
+import random
+import asyncio
+import argparse
+
+import numpy as np
+import tiktoken
+import websockets
+
+from config import get_logger
+
+logger = get_logger(__name__)
+
+encoding = tiktoken.get_encoding("cl100k_base")
+
+# A mix of short-form, long-form and data feed questions
+QUESTIONS = [
+    "What is Chainlink?",
+    "What is a Chainlink node?",
+    "How does Chainlink VRF work?",
+    "What is the difference between Chainlink Automation and a cron job?",
+    "How do I request randomness with VRF v2 in a Solidity contract?",
+    "Write a contract that consumes the ETH/USD price feed on Sepolia.",
+    "How do I run a Chainlink node with Docker?",
+    "What is CCIP and which chains does it support?",
+    "How do I fund a VRF subscription with LINK?",
+    "What is the address of the BTC/USD price feed on Ethereum mainnet?",
+    "What is the heartbeat of the LINK/ETH feed on Arbitrum?",
+    "How does Chainlink Functions call an external API?",
+]
+
+
+def load_questions(path=None):
+    if path is None:
+        return QUESTIONS
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+async def ask(websocket, question):
+    """Send one question and time the answer until its END frame."""
+    start = time.perf_counter()
+    await websocket.send(json.dumps({"message": question}))
+
+    first_token = None
+    answer = []
+    error = False
+    while True:
+        frame = json.loads(await websocket.recv())
+        if "error" in frame or frame.get("type") == "error":
+            error = True
+        elif frame.get("sender") == "bot" and frame.get("type") == "stream":
+            if first_token is None and frame["message"]:
+                first_token = time.perf_counter()
+            answer.append(frame["message"])
+        elif frame.get("sender") == "bot" and frame.get("type") == "end":
+            break
+    end = time.perf_counter()
+
+    tokens = len(encoding.encode("".join(answer)))
+    return {
+        "error": error or first_token is None,
+        "ttft": (first_token or end) - start,
+        "latency": end - start,
+        "tokens_per_sec": tokens / (end - first_token) if first_token and end > first_token else 0.0,
+    }
+
+
+async def client(url, questions, num_requests, results):
+    async with websockets.connect(url, max_size=None) as websocket:
+        for _ in range(num_requests):
+            try:
+                results.append(await ask(websocket, random.choice(questions)))
+            except websockets.ConnectionClosed as e:
+                logger.warning(f"Connection closed: {e}")
+                results.append({"error": True})
+                return
+
+
+async def run_level(url, concurrency, num_requests, questions):
+    results = []
+    start = time.perf_counter()
+    await asyncio.gather(
+        *[client(url, questions, num_requests, results) for _ in range(concurrency)],
+        return_exceptions=True,
+    )
+    return results, time.perf_counter() - start
+
+
+def report(concurrency, results, elapsed):
+    ok = [r for r in results if not r["error"]]
+    line = f"{concurrency:11d}  {len(results):8d}  {len(results) - len(ok):6d}  {len(ok) / elapsed:7.2f}"
+    if ok:
+        ttft = np.percentile([r["ttft"] * 1000 for r in ok], [50, 95, 99])
+        latency = np.percentile([r["latency"] * 1000 for r in ok], [50, 95, 99])
+        rate = np.median([r["tokens_per_sec"] for r in ok])
+        line += "  " + "  ".join(f"{v:8.0f}" for v in [*ttft, *latency]) + f"  {rate:9.1f}"
+    print(line)
+
+
+async def main(url, levels, num_requests, questions):
+    print(
+        "concurrency  requests  errors    req/s"
+        "  ttft p50  ttft p95  ttft p99   e2e p50   e2e p95   e2e p99  tok/s p50"
+    )
+    for concurrency in levels:
+        results, elapsed = await run_level(url, concurrency, num_requests, questions)
+        report(concurrency, results, elapsed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Drive the chat websocket at increasing concurrency and report latency"
+    )
+    parser.add_argument("--url", default="ws://localhost:8000/chat_chainlink")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 5, 10, 25])
+    parser.add_argument(
+        "--requests", type=int, default=5, help="Questions sent over each connection"
+    )
+    parser.add_argument("--questions", default=None, help="File with one question per line")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    asyncio.run(
+        main(args.url, args.concurrency, args.requests, load_questions(args.questions))
+    )
@@ -1,6 +1,5 @@
-import os
 import json
-import random
+import asyncio
 from dotenv import load_dotenv
 load_dotenv()
 from fastapi.templating import Jinja2Templates
@@ -16,6 +15,7 @@ from fastapi import (
     Header,
 )
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.responses import Response
 from schemas import (
     ChatInput,
     ChatResponse,
@@ -24,10 +24,32 @@ from schemas import (
     SearchRequestSchema,
     SearchResponseSchema,
 )
-from utils import get_websocket_manager, ConnectionManager, USERNAMES
+from utils import (
+    get_websocket_manager,
+    get_connection_stats,
+    ConnectionManager,
+    USERNAMES,
+)
 from chat.get_chain_no_mem import get_answer
+from chat.get_chain_mem import get_answer_memory
+from chat.memory import SessionStore
 from chat.utils import get_search_retriever, get_retriever_chain
-from config import get_logger
+from chat.router import get_local_router
+from chat.cache import AnswerCache
+from chat.key_pool import get_key_pool
+from chat.clients import client_registry
+from chat.faiss_index import get_memory_usage
+from chat.compression import compression_stats
+from chat.hedging import get_hedger
+from admission import AdmissionController, QueueFullError
+from metrics import ERRORS, render_metrics
+from config import (
+    get_logger,
+    CHAT_MAX_CONCURRENT,
+    CHAT_MAX_QUEUE,
+    SEARCH_MAX_CONCURRENT,
+    SEARCH_MAX_QUEUE,
+)
 
 ### Secure disabled for FastAPI issues with protected ws ###
 # Secure endpoints using a bearer token
@@ -43,8 +65,9 @@ from config import get_logger
 # Global variables
 logger = get_logger(__name__)
 
-API_KEYS = os.environ.get("OPENAI_API_KEYS").split(",")
-os.environ["OPENAI_API_KEY"] = random.choice(API_KEYS)
+# Keys are leased per OpenAI call from the pool, never set in the environment
+key_pool = get_key_pool()
+client_registry.add_trace_config(key_pool.trace_config())
 
 
 templates = Jinja2Templates(directory="templates")
@@ -64,9 +87,15 @@ def initial_setup():
         chain = None
         logger.error("Retriever chain not loaded: " + str(err))
 
-    return chainlink_search_retrevier, retriever, chain
+    try:
+        local_router = get_local_router()
+    except Exception as err:
+        local_router = None
+        logger.error("Local router not loaded: " + str(err))
 
-chainlink_search_retrevier, retriever, chain = initial_setup()
+    return chainlink_search_retrevier, retriever, chain, local_router
+
+chainlink_search_retrevier, retriever, chain, local_router = initial_setup()
 # Make sure the retriever is loaded
 if chainlink_search_retrevier is None:
     raise Exception("Search retriever not loaded")
@@ -75,6 +104,15 @@ if retriever is None:
 if chain is None:
     raise Exception("Chain not loaded")
 
+answer_cache = AnswerCache()
+session_store = SessionStore()
+
+# Separate limits so a burst of chats can't starve searches and vice versa
+chat_admission = AdmissionController("chat", CHAT_MAX_CONCURRENT, CHAT_MAX_QUEUE)
+search_admission = AdmissionController(
+    "search", SEARCH_MAX_CONCURRENT, SEARCH_MAX_QUEUE
+)
+
 
 app = FastAPI()
 
@@ -88,20 +126,20 @@ app.add_middleware(
 )
 
 
+@app.on_event("shutdown")
+async def shutdown():
+    await client_registry.close()
+
+
 @app.websocket("/chat_chainlink")
 async def chat_endpoint_chainlink(
     websocket: WebSocket, manager: ConnectionManager = Depends(get_websocket_manager)
 ):
+    # Reuse the shared keep-alive connections for this chat's OpenAI calls
+    client_registry.use_session()
     try:
         # verified = False
         while True:
-            # Select a random OpenAI API key
-            if not len(API_KEYS) > 0:
-                raise Exception("Not enough API keys. Set OPENAI_API_KEYS")
-
-            api_key = random.choice(API_KEYS)
-            os.environ["OPENAI_API_KEY"] = api_key
-
             data = await websocket.receive_text()
             message = ChatInput(**json.loads(data))
             logger.info(message)
@@ -126,14 +164,42 @@ async def chat_endpoint_chainlink(
             )
             await manager.broadcast(start_resp)
 
+            async def send_position(position):
+                await manager.broadcast(
+                    ChatResponse(
+                        sender=Sender.BOT,
+                        message=f"Waiting in queue (position {position})",
+                        type=MessageType.STATUS,
+                    )
+                )
+
             logger.info("Getting answer without memory")
             try:
-                answer = await get_answer(message.message, manager=manager, retriever=retriever, base_chain=chain)
+                async with chat_admission.admit(on_queued=send_position):
+                    answer = await get_answer(
+                        message.message,
+                        manager=manager,
+                        retriever=retriever,
+                        base_chain=chain,
+                        local_router=local_router,
+                        answer_cache=answer_cache,
+                    )
                 logger.debug(answer)
+            except QueueFullError as err:
+                logger.warning("Chat request shed: " + str(err))
+                ERRORS.labels(type(err).__name__).inc()
+                await manager.broadcast(
+                    ChatResponse(
+                        sender=Sender.BOT,
+                        message="The server is busy right now. Please try again in a moment.",
+                        type=MessageType.ERROR,
+                    )
+                )
             except Exception as err:
                 logger.error("Error getting answer: " + str(err))
+                ERRORS.labels(type(err).__name__).inc()
                 message = "OpenAI Error. There was an error getting an answer. Please try again."
-                await websocket.send_json({"error": message})
+                await manager.broadcast({"error": message})
 
             end_resp = ChatResponse(
                 sender=Sender.BOT,
@@ -145,6 +211,93 @@ async def chat_endpoint_chainlink(
     except WebSocketDisconnect:
         await manager.disconnect(websocket)
         logger.error(f"WebSocket disconnected")
+    except RuntimeError as err:
+        # The outbound writer closes connections that stop reading
+        await manager.disconnect(websocket)
+        logger.error(f"WebSocket closed: {err}")
+
+
+@app.websocket("/chat_chainlink_memory")
+async def chat_endpoint_chainlink_memory(
+    websocket: WebSocket, manager: ConnectionManager = Depends(get_websocket_manager)
+):
+    """Chat with conversation memory. Frames carry the session's memory_uuid;
+    send it back in ChatInput to resume the session after reconnecting."""
+    client_registry.use_session()
+    memory_uuid = None
+    try:
+        while True:
+            data = await websocket.receive_text()
+            message = ChatInput(**json.loads(data))
+            logger.info(message)
+
+            memory_uuid, memory = session_store.get(message.memory_uuid or memory_uuid)
+
+            resp = ChatResponse(
+                sender=Sender.YOU,
+                message=message.message,
+                type=MessageType.STREAM,
+                memory_uuid=memory_uuid,
+            )
+            await manager.broadcast(resp)
+
+            start_resp = ChatResponse(
+                sender=Sender.BOT, message="", type=MessageType.START, memory_uuid=memory_uuid
+            )
+            await manager.broadcast(start_resp)
+
+            async def send_position(position):
+                await manager.broadcast(
+                    ChatResponse(
+                        sender=Sender.BOT,
+                        message=f"Waiting in queue (position {position})",
+                        type=MessageType.STATUS,
+                        memory_uuid=memory_uuid,
+                    )
+                )
+
+            logger.info("Getting answer with memory")
+            try:
+                async with chat_admission.admit(on_queued=send_position):
+                    answer = await get_answer_memory(
+                        message.message,
+                        memory=memory,
+                        manager=manager,
+                        retriever=retriever,
+                        base_chain=chain,
+                        local_router=local_router,
+                        memory_uuid=memory_uuid,
+                    )
+                logger.debug(answer)
+            except QueueFullError as err:
+                logger.warning("Chat request shed: " + str(err))
+                ERRORS.labels(type(err).__name__).inc()
+                await manager.broadcast(
+                    ChatResponse(
+                        sender=Sender.BOT,
+                        message="The server is busy right now. Please try again in a moment.",
+                        type=MessageType.ERROR,
+                        memory_uuid=memory_uuid,
+                    )
+                )
+            except Exception as err:
+                logger.error("Error getting answer: " + str(err))
+                ERRORS.labels(type(err).__name__).inc()
+                error = "OpenAI Error. There was an error getting an answer. Please try again."
+                await manager.broadcast({"error": error, "memory_uuid": memory_uuid})
+
+            end_resp = ChatResponse(
+                sender=Sender.BOT, message="", type=MessageType.END, memory_uuid=memory_uuid
+            )
+            await manager.broadcast(end_resp)
+
+    except WebSocketDisconnect:
+        await manager.disconnect(websocket)
+        logger.error(f"WebSocket disconnected")
+    except RuntimeError as err:
+        # The outbound writer closes connections that stop reading
+        await manager.disconnect(websocket)
+        logger.error(f"WebSocket closed: {err}")
 
 
 @app.post(
@@ -158,9 +311,10 @@ async def chat_endpoint_chainlink(
         402: {"description": "Insufficient credit."},
         403: {"description": "Forbidden. No permission."},
         500: {"description": "Internal server error."},
+        503: {"description": "Server busy. Retry later."},
     },
 )
-def search(
+async def search(
     job: SearchRequestSchema,
     x_api_key: str = Header(None),
 ):
@@ -180,10 +334,24 @@ def search(
     job_dict = job.dict()
     logger.debug(job_dict)
 
-    # Get search results
-    results = chainlink_search_retrevier.get_relevant_documents(
-        query=job_dict["query"], type_=job_dict["type_"]
-    )
+    # Get search results, off the event loop so queued chats keep streaming
+    search_retriever = chainlink_search_retrevier
+    try:
+        async with search_admission.admit():
+            results = await asyncio.get_running_loop().run_in_executor(
+                None,
+                lambda: search_retriever.get_relevant_documents(
+                    query=job_dict["query"], type_=job_dict["type_"]
+                ),
+            )
+    except QueueFullError as err:
+        logger.warning("Search request shed: " + str(err))
+        ERRORS.labels(type(err).__name__).inc()
+        raise HTTPException(
+            status_code=503,
+            detail="Server busy. Please retry later.",
+            headers={"Retry-After": "1"},
+        )
     logger.info(f"Retrieved {len(results)} documents")
     logger.debug(results)
 
@@ -191,11 +359,56 @@ def search(
     return SearchResponseSchema(results=results)
 
 
+@app.get("/stats")
+async def stats():
+    """Worker-local websocket, queue and API key statistics."""
+    return {
+        **get_connection_stats(),
+        "api_keys": key_pool.stats(),
+        "http": client_registry.stats(),
+        "memory": get_memory_usage(),
+        "docstore": retriever.full_docs.stats(),
+        "embedding_cache": retriever.embedding_cache.stats(),
+        "embedding_batcher": retriever.embedding_batcher.stats(),
+        "compression": compression_stats.stats(),
+        "hedging": get_hedger().stats(),
+        "memory_sessions": session_store.stats(),
+        "admission": {
+            "chat": chat_admission.stats(),
+            "search": search_admission.stats(),
+        },
+    }
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics for this worker."""
+    body, content_type = render_metrics(
+        get_connection_stats(),
+        {"chat": chat_admission.stats(), "search": search_admission.stats()},
+    )
+    return Response(content=body, media_type=content_type)
+
+
 @app.post('/refresh')
-def refresh():
-    global chainlink_search_retrevier, retriever, chain
+async def refresh():
+    global chainlink_search_retrevier, retriever, chain, local_router
     try:
-        chainlink_search_retrevier, retriever, chain = initial_setup()
+        # Loading is slow and blocking, but the swap and the cache invalidation
+        # below happen on the event loop, like every cache lookup
+        loop = asyncio.get_running_loop()
+        (
+            new_search_retriever,
+            new_retriever,
+            new_chain,
+            new_local_router,
+        ) = await loop.run_in_executor(None, initial_setup)
+        # Keep serving the loaded corpus if the new one failed to load
+        if new_retriever is None or new_chain is None:
+            return {"message": "Refresh failed: retriever chain not loaded"}
+        chainlink_search_retrevier = new_search_retriever or chainlink_search_retrevier
+        retriever, chain, local_router = new_retriever, new_chain, new_local_router
+        answer_cache.invalidate(retriever.corpus_version)
         return {"message": "Refreshed."}
     except Exception as err:
         logger.error("Refresh failed: " + str(err))
@@ -0,0 +1,77 @@
+from typing import Dict
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+
+# Metrics are per worker process. Label values are small fixed sets
+# (stage, workflow, model, store); never label by question or user.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+ROUTER_SECONDS = Histogram(
+    "chat_router_seconds", "Time to pick a workflow", ["method"], buckets=LATENCY_BUCKETS
+)
+EMBEDDING_SECONDS = Histogram(
+    "chat_embedding_seconds",
+    "Duration of embedding API calls, one per batch",
+    ["model"],
+    buckets=LATENCY_BUCKETS,
+)
+SEARCH_SECONDS = Histogram(
+    "chat_search_seconds",
+    "Duration of index searches",
+    ["store", "kind"],
+    buckets=LATENCY_BUCKETS,
+)
+STAGE_SECONDS = Histogram(
+    "chat_stage_seconds",
+    "Duration of chat pipeline stages",
+    ["stage", "workflow"],
+    buckets=LATENCY_BUCKETS,
+)
+MAP_CALLS = Histogram(
+    "chat_map_calls",
+    "LLM calls needed to cover the retrieved documents",
+    ["workflow"],
+    buckets=(1, 2, 3, 4, 6, 8, 12),
+)
+TTFT_SECONDS = Histogram(
+    "chat_time_to_first_token_seconds",
+    "Time from the final LLM call to its first streamed token",
+    ["workflow", "model"],
+    buckets=LATENCY_BUCKETS,
+)
+GENERATION_SECONDS = Histogram(
+    "chat_generation_seconds",
+    "Duration of the streamed final LLM call",
+    ["workflow", "model"],
+    buckets=LATENCY_BUCKETS,
+)
+ANSWERS = Counter("chat_answers_total", "Answers sent", ["workflow", "source"])
+TOKENS_STREAMED = Counter("chat_tokens_streamed_total", "LLM tokens streamed to clients")
+ERRORS = Counter("chat_errors_total", "Failed chat and search requests", ["type"])
+HEDGES = Counter(
+    "chat_hedges_total",
+    "Late streaming calls by hedge outcome (won, lost, skipped, retry)",
+    ["outcome"],
+)
+
+ACTIVE_WEBSOCKETS = Gauge("chat_active_websockets", "Open websocket connections")
+SEND_QUEUE_DEPTH = Gauge("chat_send_queue_depth", "Frames waiting in websocket outboxes")
+ADMISSION_ACTIVE = Gauge("admission_active", "Requests being served", ["queue"])
+ADMISSION_QUEUED = Gauge("admission_queued", "Requests waiting for a slot", ["queue"])
+
+
+def render_metrics(connection_stats: Dict[str, int], admission: Dict[str, dict]):
+    """Refresh the point-in-time gauges and return (body, content type)."""
+    ACTIVE_WEBSOCKETS.set(connection_stats["active_websockets"])
+    SEND_QUEUE_DEPTH.set(connection_stats["queue_depth"])
+    for queue, stats in admission.items():
+        ADMISSION_ACTIVE.labels(queue).set(stats["active"])
+        ADMISSION_QUEUED.labels(queue).set(stats["queued"])
+    return generate_latest(), CONTENT_TYPE_LATEST
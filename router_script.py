@@ -0,0 +1,84 @@
+import time
+import random
+import argparse
+from statistics import mean
+
+from chat.router import LocalRouter, load_router_decisions
+from config import get_logger, ROUTER_CONFIDENCE, ROUTER_LOG_PATH, ROUTER_MODEL_PATH
+
+logger = get_logger(__name__)
+
+
+def load_dataset(path):
+    """Load logged decisions, keeping the latest label for each question."""
+    records = load_router_decisions(path)
+    latest = {r["question"].strip(): r for r in records if r.get("question")}
+    return list(latest.values())
+
+
+def train_task(path=ROUTER_LOG_PATH, threshold=ROUTER_CONFIDENCE):
+    records = load_dataset(path)
+    logger.info(f"Training local router on {len(records)} questions")
+
+    router = LocalRouter.train(
+        [r["question"] for r in records],
+        [r["workflow"] for r in records],
+        threshold=threshold,
+    )
+    router.save(ROUTER_MODEL_PATH)
+    logger.info(f"Saved local router to {ROUTER_MODEL_PATH}")
+
+
+def evaluate_task(path=ROUTER_LOG_PATH, thresholds=None, test_size=0.2, seed=42):
+    records = load_dataset(path)
+    random.Random(seed).shuffle(records)
+    split = int(len(records) * (1 - test_size))
+    train, test = records[:split], records[split:]
+    if not train or not test:
+        raise ValueError(f"Not enough logged decisions to evaluate: {len(records)}")
+
+    router = LocalRouter.train(
+        [r["question"] for r in train], [r["workflow"] for r in train]
+    )
+
+    # Score each held-out question once and time the local inference
+    predictions = []
+    local_ms = []
+    for r in test:
+        start = time.perf_counter()
+        workflow, confidence = router.predict(r["question"])
+        local_ms.append((time.perf_counter() - start) * 1000)
+        predictions.append((workflow, confidence, r["workflow"]))
+
+    llm_ms = mean(r.get("latency_ms", 0.0) for r in test)
+    overall = mean(p == label for p, _, label in predictions)
+
+    print(f"Train: {len(train)}  Test: {len(test)}")
+    print(f"Overall agreement with LLM router: {overall:.1%}")
+    print(f"Mean LLM router latency: {llm_ms:.0f} ms")
+    print(f"Mean local router latency: {mean(local_ms):.2f} ms")
+    print()
+    print("threshold  coverage  agreement  saved/question")
+
+    for threshold in thresholds or [ROUTER_CONFIDENCE]:
+        confident = [
+            (p, label) for p, confidence, label in predictions if confidence >= threshold
+        ]
+        coverage = len(confident) / len(predictions)
+        agreement = mean(p == label for p, label in confident) if confident else 0.0
+        saved_ms = coverage * (llm_ms - mean(local_ms))
+        print(f"{threshold:9.2f}  {coverage:8.1%}  {agreement:9.1%}  {saved_ms:11.0f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train or evaluate the local router")
+    parser.add_argument("command", choices=["train", "evaluate"])
+    parser.add_argument("--log", default=ROUTER_LOG_PATH)
+    parser.add_argument("--threshold", type=float, nargs="+", default=None)
+    parser.add_argument("--test-size", type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.command == "train":
+        train_task(args.log, threshold=(args.threshold or [ROUTER_CONFIDENCE])[0])
+    else:
+        evaluate_task(args.log, thresholds=args.threshold, test_size=args.test_size)
@@ -23,7 +23,7 @@ class ChatInput(BaseModel):
     username: Optional[str] = None
     message: str
     # memory: Optional[bool] = False
-    # # memory_uuid: Optional[str] = None
+    memory_uuid: Optional[str] = None
     # context_uuids: Optional[List[str]] = None
     assistant_uuid: Optional[str] = None
 
@@ -1,14 +1,32 @@
 import json
 import math
+import time
+import asyncio
 import logging
+import weakref
+from collections import deque
 from fastapi import WebSocket
 from pydantic import BaseModel
-from typing import Any, List, Dict
+from typing import Any, List, Dict, Optional
 from langchain.memory import ConversationBufferMemory
 from langchain.callbacks.base import AsyncCallbackHandler
 from langchain.callbacks.manager import AsyncCallbackManager
 
 from schemas import ChatResponse, Sender, MessageType
+from metrics import TOKENS_STREAMED
+from config import (
+    STREAM_FLUSH_MS,
+    STREAM_FLUSH_CHARS,
+    SEND_QUEUE_SIZE,
+    SEND_STALL_TIMEOUT,
+)
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger(__name__)
 
 USERNAMES = [
     "algovera_admin",
@@ -35,36 +53,355 @@ def createLogHandler(job_name, log_file="logs.log"):
     return logger
 
 
+# Frame encoders
+_encode_json_str = json.encoder.encode_basestring_ascii
+
+
+class JSONFrameEncoder:
+    """Encodes `ChatResponse` frames as JSON text from pre-built templates.
+
+    Only the message and memory_uuid are escaped per frame; the rest of the
+    object is formatted once per (sender, type) pair.
+    """
+
+    binary = False
+
+    def __init__(self):
+        self.templates = {
+            (sender, type_): (
+                '{"sender":"%s","message":' % sender.value,
+                ',"type":"%s","memory_uuid":' % type_.value,
+            )
+            for sender in Sender
+            for type_ in MessageType
+        }
+
+    def encode(
+        self, sender: Sender, message: str, type_: MessageType, memory_uuid=None
+    ) -> str:
+        prefix, middle = self.templates[(sender, type_)]
+        uuid = "null" if memory_uuid is None else _encode_json_str(memory_uuid)
+        return prefix + _encode_json_str(message) + middle + uuid + "}"
+
+    def encode_data(self, data: Dict) -> str:
+        return json.dumps(data, separators=(",", ":"))
+
+
+class MsgpackFrameEncoder:
+    """Encodes `ChatResponse` frames as msgpack maps from pre-packed fragments."""
+
+    binary = True
+
+    def __init__(self):
+        pack = msgpack.packb
+        self.none = pack(None)
+        self.templates = {
+            (sender, type_): (
+                b"\x84" + pack("sender") + pack(sender.value) + pack("message"),
+                pack("type") + pack(type_.value) + pack("memory_uuid"),
+            )
+            for sender in Sender
+            for type_ in MessageType
+        }
+
+    def encode(
+        self, sender: Sender, message: str, type_: MessageType, memory_uuid=None
+    ) -> bytes:
+        prefix, middle = self.templates[(sender, type_)]
+        uuid = self.none if memory_uuid is None else msgpack.packb(memory_uuid)
+        return prefix + msgpack.packb(message) + middle + uuid
+
+    def encode_data(self, data: Dict) -> bytes:
+        return msgpack.packb(data)
+
+
+FRAME_ENCODERS = {"json": JSONFrameEncoder()}
+if msgpack is not None:
+    FRAME_ENCODERS["msgpack"] = MsgpackFrameEncoder()
+
+
+def get_frame_encoder(encoding: str = "json"):
+    """Return the encoder for a negotiated encoding, defaulting to JSON."""
+    encoder = FRAME_ENCODERS.get(encoding)
+    if encoder is None:
+        logger.warning(f"Unsupported frame encoding {encoding}. Using json.")
+        encoder = FRAME_ENCODERS["json"]
+    return encoder
+
+
+# Outbound queues
+DROPPED_CONNECTIONS = 0
+
+
+class Outbox:
+    """Bounded outbound queue for one websocket, drained by a writer task.
+
+    Producers never wait on the socket. When the queue is full, STREAM
+    frames are merged into the last queued STREAM frame; other frames wait
+    for space. A connection that stays stalled for `stall_timeout` seconds
+    is closed.
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        encoder,
+        max_size: int = SEND_QUEUE_SIZE,
+        stall_timeout: float = SEND_STALL_TIMEOUT,
+    ):
+        self.websocket = websocket
+        self.encoder = encoder
+        self.max_size = max_size
+        self.stall_timeout = stall_timeout
+        self.frames = deque()
+        self.closed = False
+        self.coalesced = 0
+        self._ready = asyncio.Event()
+        self._space = asyncio.Event()
+        self._space.set()
+        self._writer = asyncio.create_task(self._write())
+
+    def __len__(self):
+        return len(self.frames)
+
+    async def put(self, frame):
+        """Queue a frame.
+
+        A frame is either a (sender, message, type, memory_uuid) tuple or a
+        dict sent as is.
+        """
+        if self.closed:
+            return
+
+        if len(self.frames) >= self.max_size:
+            if self._coalesce(frame):
+                return
+            try:
+                await asyncio.wait_for(self._wait_for_space(), self.stall_timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Outbound queue stalled. Dropping connection.")
+                await self.drop()
+                return
+            if self.closed:
+                return
+
+        self.frames.append(frame)
+        self._ready.set()
+        if len(self.frames) >= self.max_size:
+            self._space.clear()
+
+    def _coalesce(self, frame) -> bool:
+        if isinstance(frame, dict) or frame[2] != MessageType.STREAM:
+            return False
+        for i in range(len(self.frames) - 1, -1, -1):
+            queued = self.frames[i]
+            if isinstance(queued, dict) or queued[2] != MessageType.STREAM:
+                # Don't move tokens across START/END/STATUS frames
+                return False
+            if queued[0] == frame[0]:
+                self.frames[i] = (queued[0], queued[1] + frame[1]) + queued[2:]
+                self.coalesced += 1
+                return True
+        return False
+
+    async def _wait_for_space(self):
+        while len(self.frames) >= self.max_size and not self.closed:
+            await self._space.wait()
+
+    def _encode(self, frame):
+        if isinstance(frame, dict):
+            return self.encoder.encode_data(frame)
+        return self.encoder.encode(*frame)
+
+    async def _write(self):
+        try:
+            while True:
+                await self._ready.wait()
+                while self.frames:
+                    data = self._encode(self.frames.popleft())
+                    self._space.set()
+                    if isinstance(data, bytes):
+                        send = self.websocket.send_bytes(data)
+                    else:
+                        send = self.websocket.send_text(data)
+                    await asyncio.wait_for(send, self.stall_timeout)
+                self._ready.clear()
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            logger.warning("Websocket write stalled. Dropping connection.")
+            await self.drop()
+        except Exception as e:
+            logger.info(f"Websocket writer stopped: {e}")
+            await self.close(send_close=False)
+
+    async def drop(self):
+        """Close a connection that stopped reading."""
+        global DROPPED_CONNECTIONS
+        if not self.closed:
+            DROPPED_CONNECTIONS += 1
+        await self.close()
+
+    async def close(self, send_close: bool = True):
+        if self.closed:
+            return
+        self.closed = True
+        self.frames.clear()
+        self._space.set()
+        if self._writer is not asyncio.current_task():
+            self._writer.cancel()
+        if send_close:
+            try:
+                await self.websocket.close(code=1011)
+            except Exception:
+                pass
+
+
 # WebSocket Manager
+ACTIVE_MANAGERS = weakref.WeakSet()
+
+
 class ConnectionManager:
     def __init__(self):
         self.active_connections: List[WebSocket] = []
+        self.outboxes: Dict[WebSocket, Outbox] = {}
+        ACTIVE_MANAGERS.add(self)
 
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: WebSocket, encoding: str = "json"):
         await websocket.accept()
         self.active_connections.append(websocket)
+        self.outboxes[websocket] = Outbox(websocket, get_frame_encoder(encoding))
 
     async def disconnect(self, websocket: WebSocket):
         if websocket in self.active_connections:
             self.active_connections.remove(websocket)
+        outbox = self.outboxes.pop(websocket, None)
+        if outbox is not None:
+            await outbox.close(send_close=False)
+
+    def queue_depth(self) -> int:
+        return sum(len(outbox) for outbox in self.outboxes.values())
+
+    async def send_message(
+        self, sender: Sender, message: str, type_: MessageType, memory_uuid=None
+    ):
+        """Queue a chat frame without building a `ChatResponse`."""
+        for connection in self.active_connections:
+            await self.outboxes[connection].put((sender, message, type_, memory_uuid))
 
     async def broadcast(self, data: Any):
+        if isinstance(data, ChatResponse):
+            await self.send_message(
+                data.sender, data.message, data.type, data.memory_uuid
+            )
+            return
+
         if isinstance(data, BaseModel):
             data = data.dict()
         for connection in self.active_connections:
-            await connection.send_json(data)
+            await self.outboxes[connection].put(data)
+
+
+def get_connection_stats() -> Dict[str, int]:
+    """Return websocket and outbound queue statistics for this worker."""
+    managers = list(ACTIVE_MANAGERS)
+    outboxes = [o for m in managers for o in m.outboxes.values() if not o.closed]
+    return {
+        "active_websockets": len(outboxes),
+        "queue_depth": sum(len(o) for o in outboxes),
+        "max_queue_depth": max((len(o) for o in outboxes), default=0),
+        "coalesced_frames": sum(o.coalesced for o in outboxes),
+        "dropped_connections": DROPPED_CONNECTIONS,
+    }
 
 
 class StreamingLLMCallbackHandler(AsyncCallbackHandler):
-    """Callback handler for streaming LLM responses."""
+    """Callback handler for streaming LLM responses.
 
-    def __init__(self, connection_manager):
+    Tokens are coalesced and sent as one STREAM frame every `flush_interval_ms`
+    or once `flush_chars` characters are buffered, whichever comes first.
+    Frames carry `memory_uuid` when the answer belongs to a memory session.
+    """
+
+    def __init__(
+        self,
+        connection_manager,
+        flush_interval_ms: int = STREAM_FLUSH_MS,
+        flush_chars: int = STREAM_FLUSH_CHARS,
+        memory_uuid: Optional[str] = None,
+    ):
         # self.websocket = websocket
         self.connection_manager = connection_manager
+        self.memory_uuid = memory_uuid
+        self.flush_interval = flush_interval_ms / 1000
+        self.flush_chars = flush_chars
+        self.buffer: List[str] = []
+        self.buffered_chars = 0
+        self.last_flush = time.monotonic()
+        self._flush_task = None
+        self._lock = asyncio.Lock()
+        # Time from the LLM call starting to its first token, in seconds
+        self.llm_started_at = None
+        self.time_to_first_token = None
+
+    async def on_llm_start(
+        self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any
+    ) -> None:
+        self.llm_started_at = time.monotonic()
+
+    async def on_chat_model_start(
+        self, serialized: Dict[str, Any], messages: List[Any], **kwargs: Any
+    ) -> None:
+        self.llm_started_at = time.monotonic()
 
     async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
-        resp = ChatResponse(sender=Sender.BOT, message=token, type=MessageType.STREAM)
-        await self.connection_manager.broadcast(resp)
+        if self.time_to_first_token is None and self.llm_started_at is not None:
+            self.time_to_first_token = time.monotonic() - self.llm_started_at
+
+        self.buffer.append(token)
+        self.buffered_chars += len(token)
+
+        if (
+            self.buffered_chars >= self.flush_chars
+            or time.monotonic() - self.last_flush >= self.flush_interval
+        ):
+            await self.flush()
+        elif self._flush_task is None:
+            # Make sure a slow trickle of tokens still goes out on time
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def on_llm_end(self, response: Any, **kwargs: Any) -> None:
+        await self.flush()
+
+    async def on_llm_error(self, error: BaseException, **kwargs: Any) -> None:
+        await self.flush()
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        """Send the buffered tokens as a single STREAM frame."""
+        task = self._flush_task
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+            self._flush_task = None
+
+        # The lock keeps frames in order when a timed flush overlaps
+        async with self._lock:
+            if not self.buffer:
+                return
+            message = "".join(self.buffer)
+            # Counted per frame, not per token, to keep the token path cheap
+            TOKENS_STREAMED.inc(len(self.buffer))
+            self.buffer = []
+            self.buffered_chars = 0
+            self.last_flush = time.monotonic()
+
+            await self.connection_manager.send_message(
+                Sender.BOT, message, MessageType.STREAM, self.memory_uuid
+            )
 
 
 class QuestionGenCallbackHandler(AsyncCallbackHandler):
@@ -87,7 +424,9 @@ class QuestionGenCallbackHandler(AsyncCallbackHandler):
 # Dependency
 async def get_websocket_manager(websocket: WebSocket):
     manager = ConnectionManager()
-    await manager.connect(websocket)
+    # Clients opt into compact frames with ?encoding=msgpack
+    encoding = websocket.query_params.get("encoding", "json")
+    await manager.connect(websocket, encoding=encoding)
     try:
         yield manager
     finally: